@@ -0,0 +1,293 @@
+from src.spcfile import SPCFile
+from src.scanner import NSPCScanner
+from src.asm import PJASMConverter, PJSoundtrackConverter
+from src.track import Track, Pattern, Tracker, Dialect, CommandList
+from src.compress import SequenceCompressor
+from src.binary import Defines, PJBinaryWriter
+from src.synth import SynthSPC
+from main import game_list
+import argparse, io, json, os.path, random, re, sys, tempfile, time
+
+argparser = argparse.ArgumentParser(description = 'Benchmarks the converter on synthetic SPC files')
+argparser.add_argument('--games', type = str, nargs='+', choices=game_list, default=list(game_list), help = 'Games to generate SPCs for')
+argparser.add_argument('--sizes', type = str, nargs='+', choices=list(SynthSPC.sizes), default=list(SynthSPC.sizes), help = 'Song sizes')
+argparser.add_argument('--repeat', type = int, default=10, help = 'Number of runs of each stage, the fastest one counts')
+argparser.add_argument('--save', type = str, default=None, help = 'Filepath to write the timings to as JSON')
+argparser.add_argument('--compare', type = str, default=None, help = 'Filepath to a JSON baseline to check for regressions')
+argparser.add_argument('--tolerance', type = float, default=1.5, help = 'Slowdown factor over the baseline that counts as a regression')
+argparser.add_argument('--check', action='store_true', help = 'Check the conversion of the SPCs for consistency instead of timing it')
+argparser.add_argument('--seeds', type = int, default=1, help = 'Number of SPCs of each game and size')
+
+stages = ('scan', 'extract', 'dedup', 'emit', 'samples', 'total')
+
+def best_of(repeat, f):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter()-start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best*1000
+
+def scan(spc, dialect):
+    scanner = NSPCScanner(spc, dialect)
+    p_track = spc.u16(scanner.scan_tracker_pointers()+scanner.scan_track_index()*2-2)
+    return (scanner.scan_instr_table(p_track), p_track, scanner.scan_note_length_table())
+
+def dedup(tracker):
+    tracks_by_fingerprint = {}
+    for pattern in tracker.patterns.values():
+        for track in pattern.tracks:
+            if track != None:
+                tracks_by_fingerprint.setdefault(track.fingerprint(), track)
+
+def bench_spc(spc, dialect, repeat, fp):
+    timings = {}
+    p_instr_table, p_track, p_note_length_table = scan(spc, dialect)
+    timings['scan'] = best_of(repeat, lambda: scan(spc, dialect))
+    timings['extract'] = best_of(repeat, lambda: Tracker(dialect=dialect).extract(spc, p_track))
+
+    tracker = Tracker(dialect=dialect)
+    tracker.extract(spc, p_track)
+    timings['dedup'] = best_of(repeat, lambda: dedup(tracker))
+
+    converter = PJASMConverter(spc, dialect)
+    converter.extract(p_instr_table, p_track, p_note_length_table)
+    timings['emit'] = best_of(repeat, lambda: converter.write(io.StringIO()))
+    timings['samples'] = best_of(repeat, lambda: converter.sample_table.samples_to_files(fp))
+    timings['total'] = best_of(repeat, lambda: PJASMConverter(spc, dialect).convert(*scan(spc, dialect), out=io.StringIO()))
+
+    timings['commands'] = sum(len(track.commands) for track in tracker.tracks_and_subsections())
+    timings['dedup_rate'] = tracker.dedup_rate()
+    return timings
+
+def check_defines():
+    # engine addresses, and a placeholder for the bytes of every command the dialects only have names for
+    defines = Defines()
+    defines.values.update(p_spcEngine='$1500', p_extra='$0040', p_instrumentTable='$6C00', p_sampleTable='$6D00', p_sampleData='$6E00')
+    lines = ['!setNoteLengthTable', *Track.addmusicF4_command_names.values(), *Track.addmusicFA_command_names.values()]
+    for names in Track.custom_command_names.values():
+        lines += names.values()
+    for line in lines:
+        for item in line.split(','):
+            if item.startswith('!'):
+                defines.values.setdefault(item[1:], '"db $FD"')
+    return defines
+
+def slides(commands):
+    # pitch slides the engine reads right after a note, through subsection calls, nothing comes before the start of a subsection or the return from it
+    count = 0
+    previous = None
+    for command in commands:
+        if command[0] == 0xEF:
+            count += slides(command[1].commands)*command[2]
+            previous = None
+        else:
+            if command[0] == 0xF9 and previous != None and (0x80 <= previous < 0xE0 or previous == 0xF9):
+                count += 1
+            previous = command[0]
+    return count
+
+def check_spc(spc, dialect):
+    # messages for what's inconsistent in the conversion of an SPC
+    problems = []
+    addrs = scan(spc, dialect)
+    converter = PJASMConverter(spc, dialect)
+    converter.extract(*addrs)
+    subsections = converter.tracker.subsections()
+    for track in converter.tracker.tracks_and_subsections():
+        for subsection in track.commands.subsections:
+            if subsections.get(subsection.label) is not subsection:
+                problems.append(f'{track.label} calls a {subsection.label} that isn\'t the one emitted')
+
+    # the binary backend has an address for every subsection call
+    writer = PJBinaryWriter(converter, check_defines())
+    writer.layout()
+    for label, (track, data, fixups) in writer.tracks.items():
+        for offset, key in fixups:
+            if not key in writer.addrs:
+                problems.append(f'{label} refers to {key}, which has no address')
+
+    # moving commands to subsections doesn't separate a note from its pitch slides
+    compressed = PJASMConverter(spc, dialect)
+    compressed.extract(*addrs, compress=True)
+    tracks = [track for track in converter.tracker.tracks_and_subsections() if not track.is_subroutine]
+    compressed_tracks = [track for track in compressed.tracker.tracks_and_subsections() if not track.is_subroutine]
+    for track, compressed_track in zip(tracks, compressed_tracks):
+        if slides(track.commands) != slides(compressed_track.commands):
+            problems.append(f'{track.label} has {slides(track.commands)} pitch slides after notes, {slides(compressed_track.commands)} when compressed')
+
+    # every song of pj_all defines the subsections it calls
+    p_tracks = NSPCScanner(spc, dialect).scan_songs()
+    soundtrack = PJSoundtrackConverter(spc, dialect)
+    soundtrack.extract(addrs[0], p_tracks, addrs[2], compress=True, subloop_subsections=dialect.subloops)
+    for i, song in soundtrack.songs.items():
+        asm = io.StringIO()
+        song.write_banked(asm)
+        asm = asm.getvalue()
+        defined = set(re.findall(r'^(\.\w+)', asm, re.MULTILINE))
+        for label in set(re.findall(r'dw (\.\w+)', asm)):
+            if not label in defined:
+                problems.append(f'song {i:02X} calls {label} without defining it')
+    return problems
+
+def flatten(commands):
+    # the commands the engine plays, subsection calls expanded
+    flat = []
+    for command in commands:
+        if command[0] == 0xEF:
+            flat += flatten(command[1].commands)*command[2]
+        else:
+            flat.append(tuple(command))
+    return flat
+
+def check_compressor(seed):
+    # random tracks of a few commands, so that runs repeat a lot, compressed like --compress
+    rng = random.Random(seed)
+    alphabet = [(0x80,), (0x81,), (0x82,), (0xC8,), (0x18, 0x40), (0xF9, 0, 2, 0x84), (0xF9, 1, 2, 0x86), (0xE7, 0x80)]
+    tracker = Tracker(dialect=Dialect.get('common'))
+    pattern = Pattern(label='.pattern0')
+    for i in range(8):
+        pattern.tracks[i] = Track(label=f'.pattern0_{i}')
+        pattern.tracks[i].commands = CommandList(rng.choice(alphabet) for _ in range(200))
+        pattern.tracks[i].dialect = tracker.dialect
+    tracker.patterns[pattern.label] = pattern
+    before = [(flatten(track.commands), slides(track.commands)) for track in pattern.tracks]
+    SequenceCompressor(tracker).compress()
+
+    problems = []
+    for track, (flat, slide_count) in zip(pattern.tracks, before):
+        if flatten(track.commands) != flat:
+            problems.append(f'{track.label} plays different commands when compressed')
+        if slides(track.commands) != slide_count:
+            problems.append(f'{track.label} has {slide_count} pitch slides after notes, {slides(track.commands)} when compressed')
+    return problems
+
+def play_subloops(commands):
+    # the commands the engine plays for addmusic subloops, an end loops from the last start, or the beginning without one
+    played = []
+    start = 0
+    for command in commands:
+        if command[0] != 0x1E6:
+            played.append(tuple(command))
+        elif command[1] == 0:
+            start = len(played)
+        else:
+            played += played[start:]*command[1]
+    return played
+
+# addmusic tracks with subloops the engine plays in an unusual way, and the notes it plays
+subloop_cases = [
+    # a second end loops from the same start, through the repeats of the first loop
+    ([0x18, 0x7F, 0x80, 0xE6, 0x00, 0x81, 0x82, 0xE6, 0x01, 0x83, 0xE6, 0x01, 0x84, 0x00], [0x80, 0x81, 0x82, 0x81, 0x82, 0x83, 0x81, 0x82, 0x81, 0x82, 0x83, 0x84]),
+    # an end without a start loops from the beginning of the track
+    ([0x18, 0x7F, 0x80, 0x81, 0xE6, 0x02, 0x84, 0x00], [0x80, 0x81, 0x80, 0x81, 0x80, 0x81, 0x84])
+]
+
+def check_subloop_cases():
+    problems = []
+    dialect = Dialect.get('addmusic')
+    for i, (data, notes) in enumerate(subloop_cases):
+        image = bytearray(0x100+SPCFile.image_size)
+        image[0x100+0x1000:0x100+0x1000+len(data)] = bytes(data)
+        for bodies in (None, {}):
+            track = Track(label=f'.case{i}')
+            track.extract(SPCFile(image), 0x1000, dialect=dialect)
+            track.lower_subloops(bodies, {})
+            played = [command[0] for command in flatten(track.commands) if 0x80 <= command[0] < 0xE0]
+            if played != notes:
+                problems.append(f'{track.label} plays {len(played)} notes, not {len(notes)}' + ('' if bodies == None else ' with subloop subsections'))
+            if track.len != 0x18*len(notes):
+                problems.append(f'{track.label} has length {track.len}, not {0x18*len(notes)}')
+    return problems
+
+def check_subloops(seed):
+    # random tracks with addmusic subloops, lowered to subsections like --subloop_subsections and unrolled
+    rng = random.Random(seed)
+    alphabet = [(0x80,), (0x81,), (0xC8,), (0x18, 0x40), (0xF9, 0, 2, 0x84), (0xE7, 0x80)]
+    dialect = Dialect.get('addmusic')
+    bodies = {}
+    subsections = {}
+    problems = []
+    for i in range(8):
+        commands = []
+        while len(commands) < 100:
+            r = rng.random()
+            if r < 0.2:
+                commands += [(0x1E6, 0)] + [rng.choice(alphabet) for _ in range(rng.randrange(1, 6))] + [(0x1E6, rng.randrange(1, 6))]
+            elif r < 0.22:
+                # an end repeating the last loop, or the beginning of the track
+                commands.append((0x1E6, 1))
+            else:
+                commands.append(rng.choice(alphabet))
+        lowered, unrolled = Track(label=f'.pattern0_{i}'), Track(label=f'.pattern0_{i}')
+        for track in (lowered, unrolled):
+            track.commands = CommandList(commands)
+            track.dialect = dialect
+        lowered.lower_subloops(bodies, subsections)
+        unrolled.lower_subloops()
+        if flatten(unrolled.commands) != play_subloops(commands):
+            problems.append(f'{unrolled.label} plays different commands than the engine when its subloops are unrolled')
+        if flatten(lowered.commands) != flatten(unrolled.commands):
+            problems.append(f'{lowered.label} plays different commands with subloop subsections')
+        if slides(lowered.commands) != slides(unrolled.commands):
+            problems.append(f'{lowered.label} has {slides(unrolled.commands)} pitch slides after notes, {slides(lowered.commands)} with subloop subsections')
+    return problems
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+
+    if args.check:
+        problem_count = 0
+        for game in args.games:
+            dialect = Dialect.get(game)
+            for size in args.sizes:
+                for seed in range(args.seeds):
+                    name = f'{game}/{size}/{seed}'
+                    for problem in check_spc(SPCFile(SynthSPC(game, size, seed).build()), dialect):
+                        print(f'{name}: {problem}')
+                        problem_count += 1
+        for problem in check_subloop_cases():
+            print(problem)
+            problem_count += 1
+        for seed in range(args.seeds*10):
+            for problem in check_compressor(seed):
+                print(f'compressor/{seed}: {problem}')
+                problem_count += 1
+            for problem in check_subloops(seed):
+                print(f'subloops/{seed}: {problem}')
+                problem_count += 1
+        print(f'{problem_count} problems')
+        sys.exit(1 if problem_count > 0 else 0)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as fp:
+        print(f'{"":32}' + ''.join(f'{stage:>10}' for stage in stages) + '  (ms)')
+        for game in args.games:
+            dialect = Dialect.get(game)
+            for size in args.sizes:
+                name = f'{game}/{size}'
+                spc = SPCFile(SynthSPC(game, size).build())
+                results[name] = bench_spc(spc, dialect, args.repeat, fp)
+                print(f'{name:32}' + ''.join(f'{results[name][stage]:10.2f}' for stage in stages))
+
+    if args.save != None:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=1)
+
+    if args.compare != None:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        regressions = 0
+        for name, timings in results.items():
+            if not name in baseline:
+                continue
+            for stage in stages:
+                # ignore sub-millisecond noise
+                if timings[stage] > baseline[name][stage]*args.tolerance and timings[stage]-baseline[name][stage] > 1:
+                    print(f'Regression in {name} {stage}: {baseline[name][stage]:.2f} ms -> {timings[stage]:.2f} ms')
+                    regressions += 1
+        print(f'{regressions} regressions against {os.path.split(args.compare)[1]}')
+        if regressions > 0:
+            sys.exit(1)
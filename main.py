@@ -1,9 +1,16 @@
-from src.global_settings import GlobalSettings
 from src.spcfile import SPCFile
 from src.instr import SampleTable, InstrTable
 from src.scanner import NSPCScanner
-from src.asm import PJASMConverter
-import argparse, glob, os.path, sys
+from src.asm import PJSoundtrackConverter
+from src.binary import Defines, PJBinaryWriter
+from src.budget import ARAMMap, ARAMBudget
+from src.track import Dialect
+from src.api import ConversionOptions, ConversionResult, extract
+from src.bulk import convert_bulk, spc_sources, is_archive, OutputArchive, BulkOutput
+from src.cache import BulkCache
+from src.bank import SharedBank
+from src.profiler import Profiler
+import argparse, cProfile, os.path
 
 # Currently supported games
 game_list = (
@@ -14,12 +21,13 @@ game_list = (
     'thunderspirits',
     'addmusic'
 )
+game_choices = ('auto',) + game_list
 
 argparser = argparse.ArgumentParser(description = 'Converts SPC files using the N-SPC engine to ASM')
 
 subparsers = argparser.add_subparsers(dest = 'mode', help = '')
 parser_a = subparsers.add_parser('pj', help = 'ASM for PJ\'s optimized sound engine')
-parser_a.add_argument('--game', type = str, choices=game_list, default='common', help = 'Game to autodetect instrument table and tracker')
+parser_a.add_argument('--game', type = str, choices=game_choices, default='common', help = 'Game to autodetect instrument table and tracker, auto to detect the game too')
 parser_a.add_argument('--p_instr_table', type = lambda n: int(n, 16), default=None, help = 'Address of instrument table')
 parser_a.add_argument('--p_track_pointers', type = lambda n: int(n, 16), default=None, help = 'Address of tracker pointers')
 parser_a.add_argument('--p_note_length_table', type = lambda n: int(n, 16), default=None, help = 'Address of note length table')
@@ -27,73 +35,222 @@ parser_a.add_argument('--i_track', type = lambda n: int(n, 16), default=None, he
 parser_a.add_argument('--p_track', type = lambda n: int(n, 16), default=None, help = 'Address of track')
 parser_a.add_argument('--defines_fp', type = str, default='defines.asm', help = 'Relative path to defines')
 parser_a.add_argument('--export_samples', action='store_true', help = 'Whether to export samples')
+parser_a.add_argument('--subloop_subsections', action='store_true', help = 'Play addmusic subloops with subsections instead of unrolling them')
+parser_a.add_argument('--compress', action='store_true', help = 'Move command runs repeated across tracks to subsections')
+parser_a.add_argument('--dedup_samples', action='store_true', help = 'Merge samples that decode to the same audio')
+parser_a.add_argument('--sample_tolerance', type = int, default=0, help = 'Largest difference per 16-bit sample that --dedup_samples still merges')
+parser_a.add_argument('--sample_budget', type = int, default=None, help = 'Bytes of sample data to shrink the samples to, by cutting trailing silence then resampling the largest ones')
+parser_a.add_argument('--sample_ratio', type = float, default=0.75, help = 'Ratio to resample by in each step of --sample_budget')
+parser_a.add_argument('--min_sample_ratio', type = float, default=0.25, help = 'Smallest ratio --sample_budget resamples a sample to')
+parser_a.add_argument('--export_wavs', action='store_true', help = 'Whether to export samples decoded to WAV too')
 parser_a.add_argument('--amplify', type = float, default=1.0, help = 'Amplify volume by a multiplier')
 parser_a.add_argument('--prefix', type = str, default='', help = 'Prefix to add to first track')
+parser_a.add_argument('--binary', action='store_true', help = 'Write the N-SPC upload bytes instead of ASM, with the addresses read from --defines_fp')
+parser_a.add_argument('--debug_asm', type = str, default=None, help = 'Filepath to write the ASM to too with --binary')
+parser_a.add_argument('--budget', type = str, default=None, help = 'Filepath to write the size of every block and whether it fits in ARAM to as JSON, with the addresses read from --defines_fp')
+parser_a.add_argument('--aram_map', type = str, default=None, help = 'Filepath to a JSON object of block: [start, end] of the ARAM each block may use, for --budget')
+parser_a.add_argument('--profile', action='store_true', help = 'Print the time spent in each stage of the conversion')
+parser_a.add_argument('--cprofile', type = str, default=None, help = 'Filepath to write cProfile stats of the conversion to')
 parser_a.add_argument('spc', type = str, help = 'Filepath to input SPC')
-parser_a.add_argument('asm', type = str, help = 'Filepath to output ASM')
+parser_a.add_argument('asm', type = str, help = 'Filepath to output ASM (or binary)')
 
 parser_b = subparsers.add_parser('pj_bulk', help = 'Bulk ASM for PJ\'s optimized sound engine')
-parser_b.add_argument('--game', type = str, choices=game_list, default='common', help = 'Game to autodetect instrument table and tracker')
+parser_b.add_argument('--game', type = str, choices=game_choices, default='common', help = 'Game to autodetect instrument table and tracker, auto to detect the game too')
 parser_b.add_argument('--defines_fp', type = str, default='defines.asm', help = 'Relative path to defines')
 parser_b.add_argument('--export_samples', action='store_true', help = 'Whether to export samples')
+parser_b.add_argument('--subloop_subsections', action='store_true', help = 'Play addmusic subloops with subsections instead of unrolling them')
+parser_b.add_argument('--compress', action='store_true', help = 'Move command runs repeated across tracks to subsections')
+parser_b.add_argument('--dedup_samples', action='store_true', help = 'Merge samples that decode to the same audio')
+parser_b.add_argument('--sample_tolerance', type = int, default=0, help = 'Largest difference per 16-bit sample that --dedup_samples still merges')
+parser_b.add_argument('--sample_budget', type = int, default=None, help = 'Bytes of sample data to shrink the samples to, by cutting trailing silence then resampling the largest ones')
+parser_b.add_argument('--sample_ratio', type = float, default=0.75, help = 'Ratio to resample by in each step of --sample_budget')
+parser_b.add_argument('--min_sample_ratio', type = float, default=0.25, help = 'Smallest ratio --sample_budget resamples a sample to')
+parser_b.add_argument('--export_wavs', action='store_true', help = 'Whether to export samples decoded to WAV too')
 parser_b.add_argument('--amplify', type = float, default=1.0, help = 'Amplify volume by a multiplier')
 parser_b.add_argument('--prefix', type = str, default='', help = 'Prefix to add to first track')
-parser_b.add_argument('spc', type = str, help = 'Folder path to input SPCs')
-parser_b.add_argument('asm', type = str, help = 'Folder path to output ASMs (and BRRS)')
+parser_b.add_argument('--binary', action='store_true', help = 'Write the N-SPC upload bytes to .bin files instead of ASM, with the addresses read from --defines_fp')
+parser_b.add_argument('--debug_asm', action='store_true', help = 'Write the ASM too with --binary')
+parser_b.add_argument('--budget', action='store_true', help = 'Write the size of every block of every SPC and whether it fits in ARAM to nspc_budget.json, with the addresses read from --defines_fp (disables the cache)')
+parser_b.add_argument('--aram_map', type = str, default=None, help = 'Filepath to a JSON object of block: [start, end] of the ARAM each block may use, for --budget and --reject_overflow')
+parser_b.add_argument('--reject_overflow', action='store_true', help = 'Don\'t write SPCs whose blocks don\'t fit in ARAM')
+parser_b.add_argument('--shared_bank', action='store_true', help = f'Put the instruments and samples of every SPC in one bank, {SharedBank.filename}, that the ASMs include (disables the cache)')
+parser_b.add_argument('--jobs', type = int, default=1, help = 'Number of SPCs to convert in parallel (0 for one per CPU)')
+parser_b.add_argument('--no_cache', action='store_true', help = 'Convert every SPC even if it\'s unchanged since the last run')
+parser_b.add_argument('--profile', action='store_true', help = f'Print the time spent in each stage per SPC and write the totals to {Profiler.filename}.json/.csv (unchanged SPCs are skipped unless --no_cache)')
+parser_b.add_argument('--cprofile', type = str, default=None, help = 'Filename of one input SPC to write cProfile stats for, next to its ASM')
+parser_b.add_argument('spc', type = str, help = 'Folder path to input SPCs, or a zip or tar archive of them')
+parser_b.add_argument('asm', type = str, help = 'Folder path to output ASMs (and BRRS), or a zip or tar archive to write them to (disables the cache)')
+
+parser_d = subparsers.add_parser('pj_all', help = 'ASM for PJ\'s optimized sound engine of every song in one SPC, sharing one bank of instruments and samples')
+parser_d.add_argument('--game', type = str, choices=game_choices, default='common', help = 'Game to autodetect instrument table and tracker, auto to detect the game too')
+parser_d.add_argument('--p_instr_table', type = lambda n: int(n, 16), default=None, help = 'Address of instrument table')
+parser_d.add_argument('--p_note_length_table', type = lambda n: int(n, 16), default=None, help = 'Address of note length table')
+parser_d.add_argument('--defines_fp', type = str, default='defines.asm', help = 'Relative path to defines')
+parser_d.add_argument('--export_samples', action='store_true', help = 'Whether to export samples')
+parser_d.add_argument('--subloop_subsections', action='store_true', help = 'Play addmusic subloops with subsections instead of unrolling them')
+parser_d.add_argument('--compress', action='store_true', help = 'Move command runs repeated across tracks to subsections')
+parser_d.add_argument('--dedup_samples', action='store_true', help = 'Merge samples that decode to the same audio')
+parser_d.add_argument('--sample_tolerance', type = int, default=0, help = 'Largest difference per 16-bit sample that --dedup_samples still merges')
+parser_d.add_argument('--amplify', type = float, default=1.0, help = 'Amplify volume by a multiplier')
+parser_d.add_argument('--prefix', type = str, default='', help = 'Prefix to add to first track of every song')
+parser_d.add_argument('--profile', action='store_true', help = 'Print the time spent in each stage of the conversion')
+parser_d.add_argument('spc', type = str, help = 'Filepath to input SPC')
+parser_d.add_argument('asm', type = str, help = 'Folder path to output ASMs (and BRRs), named after the SPC')
 
 parser_c = subparsers.add_parser('sample', help = 'Export BRR samples to a folder')
+parser_c.add_argument('--wav', action='store_true', help = 'Decode the samples to WAV too')
+parser_c.add_argument('--loops', type = int, default=0, help = 'Number of extra times to play the loop of looping samples in WAVs')
 parser_c.add_argument('spc', type = str, help = 'Filepath to input SPC')
-parser_c.add_argument('fp', type = str, help = 'Folder path to output BRRs')
+parser_c.add_argument('fp', type = str, help = 'Folder path to output BRRs (and WAVs)')
 
-args = argparser.parse_args()
-GlobalSettings.game = args.game
+if __name__ == '__main__':
+    args = argparser.parse_args()
 
-if args.mode == 'pj':
-    spc = SPCFile(args.spc)
-    scanner = NSPCScanner(spc)
-    if args.p_track == None:
-        if args.p_track_pointers == None:
-            args.p_track_pointers = scanner.scan_tracker_pointers()
-        if args.i_track == None:
-            args.i_track = scanner.scan_track_index()
-        spc.seek(args.p_track_pointers+args.i_track*2-2)
-        args.p_track = spc.read_int(2)
-    if args.p_instr_table == None:
-        args.p_instr_table = scanner.scan_instr_table(args.p_track)
-    if args.p_note_length_table == None and GlobalSettings.game != 'addmusic':
-        args.p_note_length_table = scanner.scan_note_length_table()
-        if args.p_note_length_table == None:
-            print('note length table not detected, fallback to default')
+    if args.mode == 'pj':
+        profiler = Profiler(os.path.split(args.spc)[1], enabled=args.profile)
+        cprofiler = None
+        if args.cprofile != None:
+            cprofiler = cProfile.Profile()
+            cprofiler.enable()
+
+        with profiler.stage('read'):
+            spc = SPCFile(args.spc)
+        result = ConversionResult(os.path.split(args.spc)[1])
+        try:
+            converter = extract(spc, ConversionOptions.from_args(args), result, profiler)
+        finally:
+            if result.detected_game != None:
+                print(f'detected game: {result.detected_game}')
+            for warning in result.warnings:
+                print(warning)
+        if args.binary or args.budget != None:
+            # the defines path is relative to the output, like in the ASM
+            defines = Defines().parse(os.path.join(os.path.split(args.asm)[0], args.defines_fp))
+        if args.budget != None:
+            with profiler.stage('budget'):
+                report = ARAMBudget(converter, defines, None if args.aram_map == None else ARAMMap.load(args.aram_map, defines), args.prefix).report(os.path.split(args.spc)[1])
+                ARAMBudget.write_json([report], args.budget)
+            for message in ARAMBudget.overflows(report):
+                print(message)
+        with profiler.stage('emit'):
+            if args.binary:
+                with open(args.asm, 'wb') as file:
+                    file.write(PJBinaryWriter(converter, defines).write(args.prefix))
+                if args.debug_asm != None:
+                    with open(args.debug_asm, 'w') as asm:
+                        converter.write(asm, args.defines_fp, args.export_samples, args.prefix)
+            else:
+                with open(args.asm, 'w') as asm:
+                    converter.write(asm, args.defines_fp, args.export_samples, args.prefix)
+        if args.compress:
+            print(f'tracks compressed from {converter.sequence_sizes[0]} to {converter.sequence_sizes[1]} bytes')
+        if args.dedup_samples:
+            print(f'merged {len(converter.sample_merges)} samples, saving {converter.sample_bytes_saved} bytes')
+        if args.sample_budget != None:
+            for label, fit in converter.sample_fit.items():
+                print(f'{label}: resampled by {fit['ratio']:.3f}, {fit['bytes_before']} -> {fit['bytes_after']} bytes')
+            size = sum(len(sample.data) for sample in converter.sample_table.samples.values())
+            print(f'samples take {size} bytes, ' + ('within' if size <= args.sample_budget else 'over') + f' the budget of {args.sample_budget}')
 
-    asm = open(args.asm, 'w')
-    converter = PJASMConverter(spc)
-    asm.write(converter.convert(args.p_instr_table, args.p_track, args.p_note_length_table, args.defines_fp, args.export_samples, args.amplify, args.prefix))
+        if args.export_samples:
+            with profiler.stage('export'):
+                converter.sample_table.samples_to_files(os.path.split(args.asm)[0], hash_option=True)
+        if args.export_wavs:
+            with profiler.stage('wav'):
+                converter.sample_table.samples_to_wavs(os.path.split(args.asm)[0], hash_option=True)
 
-    if args.export_samples:
-        converter.sample_table.samples_to_files(os.path.split(args.asm)[0], hash_option=True)
-elif args.mode == 'pj_bulk':
-    for spc_path in glob.glob(os.path.join(args.spc, '*.spc')):
+        if cprofiler != None:
+            cprofiler.disable()
+            cprofiler.dump_stats(args.cprofile)
+        if args.profile:
+            print(profiler.report())
+    elif args.mode == 'pj_bulk':
+        if args.binary and args.shared_bank:
+            parser_b.error('--binary can\'t be used with --shared_bank')
+        if (args.budget or args.reject_overflow) and args.shared_bank:
+            # the blocks of a banked song depend on the whole bank, which ARAMBudget doesn't size
+            parser_b.error('--budget and --reject_overflow can\'t be used with --shared_bank')
         try:
-            spc = SPCFile(spc_path)
-            scanner = NSPCScanner(spc)
-            spc.seek(scanner.scan_tracker_pointers()+scanner.scan_track_index()*2-2)
-            p_track = spc.read_int(2)
-            p_note_length_table = scanner.scan_note_length_table()
-            if p_note_length_table == None and GlobalSettings.game != 'addmusic':
-                print('note length table not detected, fallback to default')
+            sources = spc_sources(args.spc)
+        except AssertionError as e:
+            parser_b.error(f'input: {e}')
+        cache = None if args.no_cache or args.shared_bank or args.budget or is_archive(args.asm) else BulkCache(args.asm)
+        archive = OutputArchive(args.asm) if is_archive(args.asm) else None
+        # reports go next to the archive
+        fp = BulkOutput(args.asm).fp
+        bank = SharedBank() if args.shared_bank else None
+        converted = 0
+        unchanged = 0
+        profiles = []
+        reports = []
+        for result in convert_bulk(sources, args, jobs=args.jobs, cache=cache, bank=bank):
+            if archive != None:
+                archive.write_result(result)
+            for message in result.messages:
+                print(f'{result.name}: {message}')
+            if result.cached:
+                unchanged += 1
+            elif result.success:
+                converted += 1
+            else:
+                print(f'Unable to convert {result.name}: {result.error}')
+            if result.profile != None:
+                print(result.profile.report())
+                profiles.append(result.profile)
+            if result.budget != None:
+                reports.append(result.budget)
+        if archive != None:
+            archive.close()
+        print(f'Converted {converted}/{len(sources)} SPCs, {unchanged} unchanged')
+        if bank != None:
+            print(f'shared bank has {len(bank.instr_table.instrs)} instruments and {len(bank.sample_table.samples)} samples ({bank.sample_bytes()} bytes), saving {bank.bytes_saved()} bytes of samples')
+
+        if args.budget:
+            ARAMBudget.write_json(reports, os.path.join(fp, 'nspc_budget.json'))
+            print(f'{sum(report['fits'] for report in reports)}/{len(reports)} SPCs fit in ARAM')
+        if args.profile:
+            Profiler.write_json(profiles, os.path.join(fp, Profiler.filename + '.json'))
+            Profiler.write_csv(profiles, os.path.join(fp, Profiler.filename + '.csv'))
+            print(Profiler.aggregate(profiles).report())
+    elif args.mode == 'pj_all':
+        profiler = Profiler(os.path.split(args.spc)[1], enabled=args.profile)
+        with profiler.stage('read'):
+            spc = SPCFile(args.spc)
+        with profiler.stage('scan'):
+            if args.game == 'auto':
+                scanner = NSPCScanner(spc)
+                game = scanner.detect_game()
+                print('game not detected, fallback to common' if game == None else f'detected game: {game}')
+            else:
+                scanner = NSPCScanner(spc, Dialect.get(args.game))
+            dialect = scanner.dialect
+            p_tracks = scanner.scan_songs()
+            assert len(p_tracks) > 0, 'No songs found'
+            if args.p_instr_table == None:
+                args.p_instr_table = scanner.scan_instr_table(next(iter(p_tracks.values())))
+            if args.p_note_length_table == None and dialect.has_note_length_table:
+                args.p_note_length_table = scanner.scan_note_length_table()
+        if args.p_note_length_table == None and dialect.has_note_length_table:
+            print('note length table not detected, fallback to default')
+        print('found songs ' + ', '.join(f'{i:02X}' for i in p_tracks))
 
-            spc_filename = os.path.split(spc_path)[1]
-            asm = open(os.path.join(args.asm, os.path.splitext(spc_filename)[0] + '.asm'), 'w')
-            converter = PJASMConverter(spc)
-            asm.write(converter.convert(scanner.scan_instr_table(p_track), p_track, p_note_length_table, args.defines_fp, args.export_samples, args.amplify, args.prefix))
+        converter = PJSoundtrackConverter(spc, dialect)
+        name = os.path.splitext(os.path.split(args.spc)[1])[0]
+        converter.convert(args.p_instr_table, p_tracks, args.p_note_length_table, args.asm, name, args.defines_fp, args.export_samples, args.amplify, args.prefix, profiler=profiler, sample_tolerance=args.sample_tolerance if args.dedup_samples else None, compress=args.compress, subloop_subsections=args.subloop_subsections)
+        if args.compress:
+            print(f'tracks compressed from {converter.sequence_sizes[0]} to {converter.sequence_sizes[1]} bytes')
+        if args.dedup_samples:
+            print(f'merged {len(converter.bank.sample_merges)} samples, saving {converter.bank.sample_bytes_saved} bytes')
 
-            if args.export_samples:
-                converter.sample_table.samples_to_files(args.asm, hash_option=True)
-        except:
-            print(f'Unable to convert {os.path.split(spc_path)[1]}: {repr(sys.exception())}')
-elif args.mode == 'sample':
-    spc = SPCFile(args.spc)
-    spc.seek(0x1005D) # DIR
-    sample_table = SampleTable()
-    sample_table.extract(spc, spc.read_int(1)*0x100)
-    sample_table.samples_to_files(args.fp)
+        if args.export_samples:
+            with profiler.stage('export'):
+                converter.bank.sample_table.samples_to_files(args.asm, hash_option=True)
+        if args.profile:
+            print(profiler.report())
+    elif args.mode == 'sample':
+        spc = SPCFile(args.spc)
+        sample_table = SampleTable()
+        sample_table.extract(spc, spc.u8(0x1005D)*0x100) # DIR
+        sample_table.samples_to_files(args.fp)
+        if args.wav:
+            sample_table.samples_to_wavs(args.fp, loops=args.loops)
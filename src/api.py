@@ -0,0 +1,155 @@
+from src.spcfile import SPCFile
+from src.scanner import NSPCScanner
+from src.asm import PJASMConverter
+from src.track import Dialect
+from src.profiler import Profiler
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import asyncio, io
+
+class ConversionOptions():
+    # the options of the pj mode that change the conversion, addresses left at None are scanned for
+    fields = (
+        'game', 'p_instr_table', 'p_track_pointers', 'p_note_length_table', 'i_track', 'p_track',
+        'defines_fp', 'amplify', 'prefix', 'compress', 'subloop_subsections', 'dedup_samples', 'sample_tolerance',
+        'sample_budget', 'sample_ratio', 'min_sample_ratio', 'export_wavs'
+    )
+
+    def __init__(self, game='common', p_instr_table=None, p_track_pointers=None, p_note_length_table=None, i_track=None, p_track=None,
+                 defines_fp='defines.asm', amplify=1.0, prefix='', compress=False, subloop_subsections=False, dedup_samples=False, sample_tolerance=0,
+                 sample_budget=None, sample_ratio=0.75, min_sample_ratio=0.25, export_wavs=False):
+        self.game = game
+        self.p_instr_table = p_instr_table
+        self.p_track_pointers = p_track_pointers
+        self.p_note_length_table = p_note_length_table
+        self.i_track = i_track
+        self.p_track = p_track
+        self.defines_fp = defines_fp
+        self.amplify = amplify
+        self.prefix = prefix
+        self.compress = compress
+        self.subloop_subsections = subloop_subsections
+        self.dedup_samples = dedup_samples
+        self.sample_tolerance = sample_tolerance
+        self.sample_budget = sample_budget
+        self.sample_ratio = sample_ratio
+        self.min_sample_ratio = min_sample_ratio
+        self.export_wavs = export_wavs
+
+    def from_args(args):
+        # the options of a parsed pj or pj_bulk command line, the ones it doesn't have keep their defaults
+        return ConversionOptions(**{name: getattr(args, name) for name in ConversionOptions.fields if hasattr(args, name)})
+
+class ConversionResult():
+    # what convert returns, plain data so it can be sent between processes
+    def __init__(self, name=None):
+        self.name = name
+        self.success = False
+        self.error = None
+        self.asm = None
+        self.samples = {} # filename -> BRR data, the filenames are the hashes the ASM includes
+        self.wavs = {} # filename -> WAV data, with export_wavs
+        self.game = None # dialect the SPC was converted with
+        self.detected_game = None # with game='auto', None if the game wasn't detected
+        self.addresses = {} # address name -> address, given or scanned
+        self.warnings = []
+
+def scan(spc: SPCFile, options: ConversionOptions, result: ConversionResult):
+    # fills in result.game and result.addresses, returns the dialect
+    # raises an AssertionError if the tracker or the instrument table isn't found and wasn't given
+    if options.game == 'auto':
+        scanner = NSPCScanner(spc)
+        result.detected_game = scanner.detect_game()
+        if result.detected_game == None:
+            result.warnings.append('game not detected, fallback to common')
+    else:
+        scanner = NSPCScanner(spc, Dialect.get(options.game))
+    dialect = scanner.dialect
+    result.game = dialect.game
+
+    addresses = {name: getattr(options, name) for name in ('p_track_pointers', 'i_track', 'p_track', 'p_instr_table', 'p_note_length_table')}
+    if addresses['p_track'] == None:
+        if addresses['p_track_pointers'] == None:
+            addresses['p_track_pointers'] = scanner.scan_tracker_pointers()
+            if addresses['p_track_pointers'] == None:
+                raise AssertionError('No N-SPC tracker found')
+        if addresses['i_track'] == None:
+            addresses['i_track'] = scanner.scan_track_index()
+        addresses['p_track'] = spc.u16(addresses['p_track_pointers']+addresses['i_track']*2-2)
+    if addresses['p_instr_table'] == None:
+        addresses['p_instr_table'] = scanner.scan_instr_table(addresses['p_track'])
+        if addresses['p_instr_table'] == None:
+            raise AssertionError('No N-SPC instrument table found')
+    if addresses['p_note_length_table'] == None and dialect.has_note_length_table:
+        addresses['p_note_length_table'] = scanner.scan_note_length_table()
+        if addresses['p_note_length_table'] == None:
+            result.warnings.append('note length table not detected, fallback to default')
+    result.addresses = addresses
+    return dialect
+
+def extract(spc: SPCFile, options: ConversionOptions, result: ConversionResult, profiler: Profiler=None):
+    # scans and extracts the song, returns the converter ready to write
+    profiler = Profiler(enabled=False) if profiler == None else profiler
+    with profiler.stage('scan'):
+        dialect = scan(spc, options, result)
+    addresses = result.addresses
+    converter = PJASMConverter(spc, dialect)
+    converter.extract(addresses['p_instr_table'], addresses['p_track'], addresses['p_note_length_table'], options.amplify, profiler, sample_tolerance=options.sample_tolerance if options.dedup_samples else None, compress=options.compress, subloop_subsections=options.subloop_subsections, sample_budget=options.sample_budget, sample_ratio=options.sample_ratio, min_sample_ratio=options.min_sample_ratio)
+    return converter
+
+def convert(spc_data, options: ConversionOptions=None, name=None):
+    # converts the bytes of an SPC to the ASM of the pj mode without touching the filesystem,
+    # the samples are named by their hashes like with --export_samples and returned with the ASM
+    result = ConversionResult(name)
+    convert_to(spc_data, options, result)
+    return result
+
+def convert_to(spc_data, options: ConversionOptions, result: ConversionResult):
+    # convert into result, what was detected before a failure stays in it
+    options = ConversionOptions() if options == None else options
+    converter = extract(SPCFile(bytes(spc_data)), options, result)
+    asm = io.StringIO()
+    converter.write(asm, options.defines_fp, True, options.prefix)
+    result.asm = asm.getvalue()
+    result.samples = dict(converter.sample_table.sample_files(hash_option=True))
+    if options.export_wavs:
+        result.wavs = dict(converter.sample_table.wav_files(hash_option=True))
+    result.success = True
+
+def convert_item(name, spc_data, options: ConversionOptions=None):
+    # runs in a worker, so every exception is turned into a result instead of escaping
+    result = ConversionResult(name)
+    try:
+        convert_to(spc_data, options, result)
+    except Exception as e:
+        result.error = repr(e)
+    return result
+
+def batch_items(inputs):
+    # inputs are SPC bytes, named by their index, or (name, SPC bytes)
+    for i, item in enumerate(inputs):
+        yield item if type(item) == tuple else (i, item)
+
+def convert_batch(inputs, options: ConversionOptions=None, jobs=None, executor=None):
+    # yields a result for every input as soon as it's converted, not in the order of the inputs
+    # runs in a process pool of jobs processes unless an executor is given
+    own_executor = executor == None
+    if own_executor:
+        executor = ProcessPoolExecutor(jobs)
+    try:
+        futures = [executor.submit(convert_item, name, spc_data, options) for name, spc_data in batch_items(inputs)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+async def convert_async(spc_data, options: ConversionOptions=None, name=None, executor=None):
+    # convert in an executor, the default one of the event loop unless one is given
+    return await asyncio.get_running_loop().run_in_executor(executor, convert, spc_data, options, name)
+
+async def convert_batch_async(inputs, options: ConversionOptions=None, executor=None):
+    # the results of convert_batch as an async generator, conversions run in the executor while the loop serves other tasks
+    loop = asyncio.get_running_loop()
+    futures = [loop.run_in_executor(executor, convert_item, name, spc_data, options) for name, spc_data in batch_items(inputs)]
+    for future in asyncio.as_completed(futures):
+        yield await future
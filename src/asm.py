@@ -1,94 +1,269 @@
-from src.global_settings import GlobalSettings
 from src.spcfile import SPCFile
 from src.instr import BRRSample, SampleTable, InstrTable
-from src.track import Track, Pattern, Tracker
+from src.track import Track, Pattern, Tracker, Dialect, ParseCache
+from src.profiler import Profiler
+from src.compress import SequenceCompressor
+from src.fitter import SampleFitter
+import io, os.path
 
 class PJASMConverter():
-    def __init__(self, spc):
+    def __init__(self, spc, dialect: Dialect=None):
         self.spc = spc
-        self.asm = ''
-
-    def convert(self, p_instr_table, p_track, p_note_length_table, defines_fp='defines.asm', hash_option=False, vol_multiplier=1.0, prefix=''):
-        self.spc.seek(0x1000C)
-        main_vol_l = self.spc.read_int(1)
-        self.spc.seek(0x1001C)
-        main_vol_r = self.spc.read_int(1)
-
-        self.asm += 'asar 1.91\n'
-        self.asm += 'norom : org 0\n'
-        self.asm += f'incsrc "{defines_fp}"\n\n'
-
-        tracker = Tracker(label=f'Tracker{p_track:04X}')
-        tracker.extract(self.spc, p_track)
-        for track in tracker.tracks_and_subsections():
-            track.amplify(vol_multiplier)
-            track.normalize_echo_volume(main_vol_l=main_vol_l, main_vol_r=main_vol_r)
-
-        perc_base = tracker.perc_base()
-        used_instrs = tracker.used_instrs(perc_base=perc_base)
-        first_perc = None if len(used_instrs[1]) == 0 else min(used_instrs[1])
-
-        instr_map = InstrTable.instr_map(used_instrs[0] | used_instrs[1], base=0x16)
-        self.asm += InstrTable.instr_defines(instr_map) + '\n'
-
-        instr_table = InstrTable()
-        used_sample_ids = instr_table.extract(self.spc, p_instr_table, used_instrs=used_instrs[0] | used_instrs[1])
-        sample_map = SampleTable.sample_map(used_sample_ids, base=0x16)
-        self.asm += SampleTable.sample_defines(sample_map) + '\n'
-
-        self.asm += 'spcblock 6*$16+!p_instrumentTable nspc ; instruments\n'
-        self.asm += instr_table.to_asm()
-        self.asm += 'endspcblock\n\n'
-
-        self.spc.seek(0x1005D) # DIR
-        self.sample_table = SampleTable()
-        self.sample_table.extract(self.spc, self.spc.read_int(1)*0x100, used_sample_ids=used_sample_ids)
-        self.asm += 'spcblock 4*$16+!p_sampleTable nspc ; sample table\n'
-        self.asm += self.sample_table.sample_table_to_asm()
-        self.asm += 'endspcblock\n\n'
-
-        self.asm += 'spcblock $B210-$6E00+!p_sampleData nspc ; sample data\n'
-        self.asm += self.sample_table.samples_to_asm('', hash_option) + '\n'
+        self.dialect = Dialect.get('common') if dialect == None else dialect
 
+    def convert(self, p_instr_table, p_track, p_note_length_table, defines_fp='defines.asm', hash_option=False, vol_multiplier=1.0, prefix='', out=None, profiler: Profiler=None, sample_tolerance=None, compress=False, subloop_subsections=False, sample_budget=None, sample_ratio=0.75, min_sample_ratio=0.25):
+        # writes the ASM to out (any text file object) section by section, or returns it as a string if out is None
+        # with a sample_tolerance, samples that decode to the same audio within it are merged
+        # with compress, repeated runs of commands are moved to subsections
+        # with subloop_subsections, addmusic subloops are played by subsections instead of being unrolled
+        # with a sample_budget, samples are resampled by sample_ratio at a time, down to min_sample_ratio, until they fit in it
+        if profiler == None:
+            profiler = Profiler(enabled=False)
+        self.extract(p_instr_table, p_track, p_note_length_table, vol_multiplier, profiler, sample_tolerance, compress, subloop_subsections, sample_budget, sample_ratio, min_sample_ratio)
+
+        if out == None:
+            out = io.StringIO()
+            with profiler.stage('emit'):
+                self.write(out, defines_fp, hash_option, prefix)
+            return out.getvalue()
+        with profiler.stage('emit'):
+            self.write(out, defines_fp, hash_option, prefix)
+
+    def extract(self, p_instr_table, p_track, p_note_length_table, vol_multiplier=1.0, profiler: Profiler=None, sample_tolerance=None, compress=False, subloop_subsections=False, sample_budget=None, sample_ratio=0.75, min_sample_ratio=0.25):
+        if profiler == None:
+            profiler = Profiler(enabled=False)
+        self.extract_tracker(p_track, profiler)
+        profiler.count('bytes_decoded', sum(track.size for track in self.tracker.cache.tracks.values()))
+        self.sequence_sizes = PJASMConverter.process_tracks(self.tracker, self.spc, vol_multiplier, profiler, compress, subloop_subsections)
+        with profiler.stage('instruments'):
+            used_instrs = self.extract_percussion()
+        self.extract_bank(p_instr_table, used_instrs, profiler, sample_tolerance, sample_budget, sample_ratio, min_sample_ratio)
+        self.extract_note_length_table(p_note_length_table)
+
+    def extract_tracker(self, p_track, profiler: Profiler, cache: ParseCache=None):
+        self.tracker = Tracker(label=f'Tracker{p_track:04X}', dialect=self.dialect, cache=cache)
+        with profiler.stage('extract'):
+            self.tracker.extract(self.spc, p_track, profiler)
+        profiler.count('tracks', self.tracker.track_count)
+        profiler.count('duplicates', self.tracker.duplicate_track_count)
+
+    def process_tracks(tracker: Tracker, spc: SPCFile, vol_multiplier=1.0, profiler: Profiler=None, compress=False, subloop_subsections=False):
+        # everything done to the parsed tracks before they are emitted, returns the sizes before and after compression if done
+        main_vol_l = spc.u8(0x1000C)
+        main_vol_r = spc.u8(0x1001C)
+
+        with profiler.stage('subloops'):
+            tracker.lower_subloops(subloop_subsections)
+        profiler.count('subsections', len(tracker.subsections()))
+
+        with profiler.stage('volume'):
+            for track in tracker.tracks_and_subsections():
+                track.amplify(vol_multiplier)
+                track.normalize_echo_volume(main_vol_l=main_vol_l, main_vol_r=main_vol_r)
+
+        sequence_sizes = None
+        if compress:
+            with profiler.stage('compress'):
+                sequence_sizes = SequenceCompressor(tracker).compress()
+            profiler.count('sequence_bytes_saved', sequence_sizes[0]-sequence_sizes[1])
+        return sequence_sizes
+
+    def extract_percussion(self):
+        # returns the used (instruments, percussion instruments)
+        self.perc_base = self.tracker.perc_base()
+        used_instrs = self.tracker.used_instrs(perc_base=self.perc_base)
+        self.first_perc = None if len(used_instrs[1]) == 0 else min(used_instrs[1])
+        return used_instrs
+
+    def extract_bank(self, p_instr_table, used_instrs, profiler: Profiler, sample_tolerance=None, sample_budget=None, sample_ratio=0.75, min_sample_ratio=0.25):
+        with profiler.stage('instruments'):
+            self.instr_map = InstrTable.instr_map(used_instrs[0] | used_instrs[1], base=0x16)
+
+            self.instr_table = InstrTable()
+            used_sample_ids = self.instr_table.extract(self.spc, p_instr_table, used_instrs=used_instrs[0] | used_instrs[1])
+
+            self.sample_table = SampleTable()
+            self.sample_table.extract(self.spc, self.spc.u8(0x1005D)*0x100, used_sample_ids=used_sample_ids) # DIR
+
+        self.sample_merges = {}
+        self.sample_bytes_saved = 0
+        if sample_tolerance != None:
+            with profiler.stage('sample_dedup'):
+                self.sample_merges, self.sample_bytes_saved = self.sample_table.dedup(sample_tolerance)
+            profiler.count('sample_bytes_saved', self.sample_bytes_saved)
+        self.sample_fit = {}
+        if sample_budget != None:
+            with profiler.stage('sample_fit'):
+                self.sample_fit = SampleFitter(self.sample_table, self.instr_table, self.sample_merges).fit(sample_budget, sample_ratio, min_sample_ratio)
+            profiler.count('sample_bytes_fitted', sum(fit['bytes_before']-fit['bytes_after'] for fit in self.sample_fit.values()))
+        # merged samples share the !sampleXX value of the sample they were merged into
+        self.sample_map = SampleTable.sample_map([i for i in used_sample_ids if not i in self.sample_merges], base=0x16)
+        for i, j in self.sample_merges.items():
+            self.sample_map[i] = self.sample_map[j]
+        self.sample_map = dict(sorted(self.sample_map.items()))
+        profiler.count('samples', len(self.sample_table.samples))
+        profiler.count('sample_bytes', sum(len(sample.data) for sample in self.sample_table.samples.values()))
+
+    def extract_note_length_table(self, p_note_length_table):
         if p_note_length_table != None:
-            self.spc.seek(p_note_length_table)
-            note_length_table = [self.spc.read_int(1) for _ in range(0x18)]
+            self.note_length_table = list(self.spc.slice(p_note_length_table, 0x18))
         else:
             # use defaults
-            if GlobalSettings.game == 'addmusic':
-                note_length_table = Track.addmusic_note_length_table_standard[:]
-            else:
-                note_length_table = Track.standard_note_length_table[:]
-
-        if note_length_table != Track.standard_note_length_table:
-            self.asm += 'NoteLengthTable: ; note length table\n'
-            self.asm += f'  db ${',$'.join(f'{b:02X}' for b in note_length_table[:8])}\n'
-            self.asm += f'  db ${',$'.join(f'{b:02X}' for b in note_length_table[8:])}\n\n'
-
-        self.asm += 'dw 0,0,0,0 ; padding for shared trackers\n'
-        self.asm += 'Trackers:\n'
-        self.asm += f'  dw {tracker.label}\n\n'
-
-        self.asm += tracker.to_asm() + '\n'
-        for pattern in tracker.patterns.values():
-            self.asm += pattern.to_asm() + '\n'
-        self.asm += '\n'
+            self.note_length_table = self.dialect.note_length_table[:]
+
+    def write(self, out, defines_fp='defines.asm', hash_option=False, prefix=''):
+        for section in (
+            self.header_asm(defines_fp),
+            self.instr_table_asm(),
+            self.sample_table_asm(),
+            self.sample_data_asm(hash_option),
+            self.note_length_table_asm(),
+            self.tracker_asm(),
+            self.tracks_asm(prefix),
+            self.footer_asm()
+        ):
+            for chunk in section:
+                out.write(chunk)
+
+    def write_banked(self, out, defines_fp='defines.asm', bank_fp='bank.asm', prefix='', instr_defines=False):
+        # the song only, placed after the sample data of a bank that has the instruments and samples
+        # instr_defines is for banks that don't define the !instrXX of the song
+        for section in (
+            ('asar 1.91\n', 'norom : org 0\n', f'incsrc "{defines_fp}"\n', f'incsrc "{bank_fp}"\n\n'),
+            (InstrTable.instr_defines(self.instr_map) + '\n',) if instr_defines else (),
+            ('spcblock SongData nspc ; song\n',),
+            self.note_length_table_asm(),
+            self.tracker_asm(),
+            self.tracks_asm(prefix),
+            self.footer_asm()
+        ):
+            for chunk in section:
+                out.write(chunk)
+
+    def header_asm(self, defines_fp):
+        yield 'asar 1.91\n'
+        yield 'norom : org 0\n'
+        yield f'incsrc "{defines_fp}"\n\n'
+        yield from self.defines_asm()
+
+    def defines_asm(self):
+        yield InstrTable.instr_defines(self.instr_map) + '\n'
+        yield SampleTable.sample_defines(self.sample_map) + '\n'
+
+    def instr_table_asm(self):
+        yield 'spcblock 6*$16+!p_instrumentTable nspc ; instruments\n'
+        yield self.instr_table.to_asm()
+        yield 'endspcblock\n\n'
+
+    def sample_table_asm(self):
+        yield 'spcblock 4*$16+!p_sampleTable nspc ; sample table\n'
+        yield self.sample_table.sample_table_to_asm()
+        yield 'endspcblock\n\n'
+
+    def sample_data_asm(self, hash_option):
+        yield 'spcblock $B210-$6E00+!p_sampleData nspc ; sample data\n'
+        yield self.sample_table.samples_to_asm('', hash_option) + '\n'
+
+    def note_length_table_asm(self):
+        if self.note_length_table != Track.standard_note_length_table:
+            yield 'NoteLengthTable: ; note length table\n'
+            yield f'  db ${',$'.join(f'{b:02X}' for b in self.note_length_table[:8])}\n'
+            yield f'  db ${',$'.join(f'{b:02X}' for b in self.note_length_table[8:])}\n\n'
+
+    def tracker_asm(self):
+        yield 'dw 0,0,0,0 ; padding for shared trackers\n'
+        yield 'Trackers:\n'
+        yield f'  dw {self.tracker.label}\n\n'
+
+        yield self.tracker.to_asm() + '\n'
+        for pattern in self.tracker.patterns.values():
+            yield pattern.to_asm() + '\n'
+
+    def tracks_asm(self, prefix):
+        # tracks and subsections are separated by an empty line
+        use_custom_note_length_table = self.note_length_table != Track.standard_note_length_table
+        first_track = next(iter(self.tracker.patterns.values())).tracks[0]
         used_tracks = set()
-        for pattern in tracker.patterns.values():
+        for pattern in self.tracker.patterns.values():
             end = True
             for track in pattern.tracks:
                 if track != None and not track.label in used_tracks:
-                    self.asm += track.to_asm(end=end, perc_base=perc_base, first_perc=first_perc, use_custom_note_length_table=note_length_table != Track.standard_note_length_table, prefix=prefix, spc=self.spc) + '\n'
+                    yield '\n'
+                    yield from track.asm_lines(end=end, perc_base=self.perc_base, first_perc=self.first_perc, use_custom_note_length_table=use_custom_note_length_table, prefix=prefix, spc=self.spc, first=track is first_track)
                     used_tracks.add(track.label)
                     #end = False
 
-        for subsection in tracker.subsections().values():
-            self.asm += subsection.to_asm(perc_base=perc_base, first_perc=first_perc) + '\n'
+        for subsection in self.tracker.subsections().values():
+            yield '\n'
+            yield from subsection.asm_lines(perc_base=self.perc_base, first_perc=self.first_perc)
+
+    def footer_asm(self):
+        yield 'endspcblock\n\n'
+        yield 'spcblock !p_extra nspc\n'
+        yield '  dw Trackers-8 : db 0\n'
+        yield 'endspcblock execute !p_spcEngine\n'
+
+class PJSoundtrackConverter():
+    # converts every song of an SPC at once, the songs share their parsed tracks and one bank of instruments and samples
+    # the bank ASM has the defines and the instrument, sample table and sample data blocks, every song ASM includes it
+    def __init__(self, spc, dialect: Dialect=None):
+        self.spc = spc
+        self.dialect = Dialect.get('common') if dialect == None else dialect
+
+    def convert(self, p_instr_table, p_tracks, p_note_length_table, fp, name, defines_fp='defines.asm', hash_option=False, vol_multiplier=1.0, prefix='', profiler: Profiler=None, sample_tolerance=None, compress=False, subloop_subsections=False):
+        # writes {name}_bank.asm and {name}_{track index}.asm for every song in p_tracks ({track index: tracker address}) to fp
+        # returns the paths written
+        if profiler == None:
+            profiler = Profiler(enabled=False)
+        self.extract(p_instr_table, p_tracks, p_note_length_table, vol_multiplier, profiler, sample_tolerance, compress, subloop_subsections)
+
+        with profiler.stage('emit'):
+            bank_fn = f'{name}_bank.asm'
+            paths = [os.path.join(fp, bank_fn)]
+            with open(paths[0], 'w') as out:
+                self.write_bank(out, hash_option)
+            for i, song in self.songs.items():
+                paths.append(os.path.join(fp, f'{name}_{i:02X}.asm'))
+                with open(paths[-1], 'w') as out:
+                    song.write_banked(out, defines_fp, bank_fn, prefix)
+        return paths
+
+    def extract(self, p_instr_table, p_tracks, p_note_length_table, vol_multiplier=1.0, profiler: Profiler=None, sample_tolerance=None, compress=False, subloop_subsections=False):
+        if profiler == None:
+            profiler = Profiler(enabled=False)
+        self.cache = ParseCache()
+        self.songs = {}
+        for i, p_track in p_tracks.items():
+            song = PJASMConverter(self.spc, self.dialect)
+            song.extract_tracker(p_track, profiler, self.cache)
+            song.extract_note_length_table(p_note_length_table)
+            self.songs[i] = song
+        profiler.count('bytes_decoded', sum(track.size for track in self.cache.tracks.values()))
+
+        # songs share tracks, so the tracks of all songs are processed together, then every song keeps the subsections it calls
+        tracker = Tracker(dialect=self.dialect, cache=self.cache)
+        for song in self.songs.values():
+            for label, pattern in song.tracker.patterns.items():
+                tracker.patterns[song.tracker.label + label] = pattern
+        self.sequence_sizes = PJASMConverter.process_tracks(tracker, self.spc, vol_multiplier, profiler, compress, subloop_subsections)
 
-        self.asm = self.asm[:-1] # delete newline
-        self.asm += 'endspcblock\n\n'
-        self.asm += 'spcblock !p_extra nspc\n'
-        self.asm += '  dw Trackers-8 : db 0\n'
-        self.asm += 'endspcblock execute !p_spcEngine\n'
+        used_instrs = (set(), set())
+        with profiler.stage('instruments'):
+            for song in self.songs.values():
+                song.tracker.select_subsections()
+                song_used_instrs = song.extract_percussion()
+                used_instrs[0].update(song_used_instrs[0])
+                used_instrs[1].update(song_used_instrs[1])
+        self.bank = PJASMConverter(self.spc, self.dialect)
+        self.bank.extract_bank(p_instr_table, used_instrs, profiler, sample_tolerance)
 
-        return self.asm
+    def write_bank(self, out, hash_option=False):
+        for section in (
+            self.bank.defines_asm(),
+            self.bank.instr_table_asm(),
+            self.bank.sample_table_asm(),
+            self.bank.sample_data_asm(hash_option),
+            ('SongData: ; the songs follow the samples\n', 'endspcblock\n')
+        ):
+            for chunk in section:
+                out.write(chunk)
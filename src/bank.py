@@ -0,0 +1,99 @@
+from src.instr import BRRSample, SampleTable, InstrTable
+import hashlib
+
+class SharedBank():
+    # one instrument and sample table for many songs, samples with the same BRR data and loop point are stored once
+    # IDs are given in the order songs are added, so the same songs added in the same order always get the same bank
+    max_percussion_offset = 0xDF-0xCA # percussion notes are $CA-$DF
+    filename = 'bank.asm'
+
+    def __init__(self, base=0x16):
+        self.base = base
+        self.instr_table = InstrTable()
+        self.sample_table = SampleTable()
+        self.instr_slots = {} # (sample key, instrument bytes) -> slot of its first copy
+        self.sample_indices = {} # sample key -> index in the bank
+        self.instr_maps = {} # song name -> {song instrument: slot}
+        self.song_sample_bytes = 0
+
+    def entry(converter):
+        # what the bank needs from one extracted song, as plain data so it can be sent between processes:
+        # ({instrument: (sample key, instrument bytes)}, sorted percussion instruments, {sample key: (data, loop point, loop)})
+        sample_labels = dict(zip(converter.sample_table.sample_ids, converter.sample_table.sample_labels))
+        instrs = {}
+        samples = {}
+        for i, instr in zip(sorted(converter.instr_map), converter.instr_table.instrs):
+            sample_id = converter.sample_merges.get(instr[0], instr[0])
+            sample = converter.sample_table.samples[sample_labels[sample_id]]
+            key = SharedBank.sample_key(sample)
+            instrs[i] = (key, bytes(instr[1:]))
+            samples[key] = (bytes(sample.data), sample.loop_point, sample.loop)
+        percussion = [] if converter.first_perc == None else sorted(converter.tracker.used_instrs(perc_base=converter.perc_base)[1])
+        return instrs, percussion, samples
+
+    def sample_key(sample: BRRSample):
+        return f'{hashlib.md5(sample.data).hexdigest()}_{sample.loop_point:04X}'
+
+    def add(self, name, entry):
+        # adds the instruments and samples of a song that aren't in the bank yet, returns {song instrument: slot}
+        instrs, percussion, samples = entry
+        self.song_sample_bytes += sum(len(data) for data, loop_point, loop in samples.values())
+        instr_map = {}
+
+        # percussion notes select an instrument relative to the first percussion instrument of the song,
+        # so the slots of the percussion instruments keep their order, otherwise they're added again next to each other
+        slots = [self.instr_slots.get(instrs[i]) for i in percussion]
+        if None in slots or any(not 0 <= slot-slots[0] <= SharedBank.max_percussion_offset for slot in slots):
+            slots = [self.new_instr(instrs[i], samples) for i in percussion]
+        instr_map.update(zip(percussion, slots))
+
+        for i in sorted(instrs):
+            if not i in instr_map:
+                slot = self.instr_slots.get(instrs[i])
+                instr_map[i] = self.new_instr(instrs[i], samples) if slot == None else slot
+        self.instr_maps[name] = dict(sorted(instr_map.items()))
+        return self.instr_maps[name]
+
+    def new_instr(self, instr, samples):
+        key, instr_bytes = instr
+        if not key in self.sample_indices:
+            data, loop_point, loop = samples[key]
+            self.sample_indices[key] = len(self.sample_indices)
+            label = f'Sample{self.sample_indices[key]:02X}'
+            sample = BRRSample(label)
+            sample.data = bytearray(data)
+            sample.loop_point = loop_point
+            sample.loop = loop
+            self.sample_table.samples[label] = sample
+            self.sample_table.sample_labels.append(label)
+            self.sample_table.sample_ids.append(self.sample_indices[key])
+
+        slot = self.base+len(self.instr_table.instrs)
+        if slot > 0xFF:
+            raise AssertionError('Shared bank has more instruments than fit in the instrument table')
+        if self.base+len(self.sample_indices) > 0x100:
+            raise AssertionError('Shared bank has more samples than fit in the sample table')
+        self.instr_table.instrs.append([self.sample_indices[key]] + list(instr_bytes))
+        self.instr_slots.setdefault(instr, slot)
+        return slot
+
+    def sample_bytes(self):
+        return sum(len(sample.data) for sample in self.sample_table.samples.values())
+
+    def bytes_saved(self):
+        # sample data of all songs minus what the bank stores
+        return self.song_sample_bytes-self.sample_bytes()
+
+    def write(self, out, hash_option=False):
+        # the songs are placed after the sample data, at SongData
+        out.write(SampleTable.sample_defines(SampleTable.sample_map(self.sample_table.sample_ids, base=self.base)) + '\n')
+        out.write(f'spcblock 6*${self.base:02X}+!p_instrumentTable nspc ; instruments\n')
+        out.write(self.instr_table.to_asm())
+        out.write('endspcblock\n\n')
+        out.write(f'spcblock 4*${self.base:02X}+!p_sampleTable nspc ; sample table\n')
+        out.write(self.sample_table.sample_table_to_asm())
+        out.write('endspcblock\n\n')
+        out.write('spcblock $B210-$6E00+!p_sampleData nspc ; sample data\n')
+        out.write(self.sample_table.samples_to_asm('', hash_option) + '\n')
+        out.write('SongData: ; the songs follow the samples\n')
+        out.write('endspcblock\n')
@@ -0,0 +1,258 @@
+from src.track import Track
+import ast, operator, os.path, re
+
+class Defines():
+    # the !defines of an asar file, for the addresses of the engine and the bytes of the commands it defines
+    # values are kept as text and evaluated when used, numbers can be expressions of other defines
+    define_pattern = re.compile(r'^\s*!([A-Za-z_]\w*)\s*\??=\s*(.*?)\s*$')
+    incsrc_pattern = re.compile(r'^\s*incsrc\s+"?([^";]+?)"?\s*$')
+    expression_pattern = re.compile(r'^[0-9\s()+\-*/<>&|^~]*$')
+    binary_operators = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.floordiv,
+        ast.LShift: operator.lshift,
+        ast.RShift: operator.rshift,
+        ast.BitAnd: operator.and_,
+        ast.BitOr: operator.or_,
+        ast.BitXor: operator.xor
+    }
+    unary_operators = {
+        ast.USub: operator.neg,
+        ast.UAdd: operator.pos,
+        ast.Invert: operator.invert
+    }
+
+    def __init__(self):
+        self.values = {}
+        self.paths = [] # files parsed, the incsrc'd ones included
+
+    def parse(self, path):
+        fp = os.path.split(path)[0]
+        self.paths.append(path)
+        with open(path, 'r') as file:
+            for line in file:
+                line = Defines.strip_comment(line)
+                match = Defines.define_pattern.match(line)
+                if match != None:
+                    self.values[match.group(1)] = match.group(2)
+                    continue
+                match = Defines.incsrc_pattern.match(line)
+                if match != None:
+                    self.parse(os.path.join(fp, match.group(1)))
+        return self
+
+    def strip_comment(line):
+        # ; starts a comment unless it's in a string
+        in_string = False
+        for i, c in enumerate(line):
+            if c == '"':
+                in_string = not in_string
+            elif c == ';' and not in_string:
+                return line[:i]
+        return line
+
+    def value(self, name):
+        if not name in self.values:
+            raise AssertionError(f'!{name} is not defined')
+        return self.evaluate(self.values[name], name)
+
+    def evaluate(self, text, name=None):
+        # asar number syntax ($hex, %binary, decimal) and operators, parsed as a python expression of integers
+        # name is the define the text is the value of, for errors
+        expression = re.sub(r'!([A-Za-z_]\w*)', lambda match: str(self.value(match.group(1))), text)
+        expression = re.sub(r'\$([0-9A-Fa-f]+)', lambda match: str(int(match.group(1), 16)), expression)
+        expression = re.sub(r'%([01]+)', lambda match: str(int(match.group(1), 2)), expression)
+        source = text if name == None else f'!{name} = {text}'
+        if not Defines.expression_pattern.match(expression):
+            raise AssertionError(f'Unable to evaluate {source}')
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            raise AssertionError(f'Unable to evaluate {source}')
+        return Defines.evaluate_node(tree.body, source)
+
+    def evaluate_node(node, source):
+        # only integers and the operators of binary_operators and unary_operators, shifts by less than 64
+        if type(node) == ast.Constant and type(node.value) == int:
+            return node.value
+        if type(node) == ast.UnaryOp and type(node.op) in Defines.unary_operators:
+            return Defines.unary_operators[type(node.op)](Defines.evaluate_node(node.operand, source))
+        if type(node) == ast.BinOp and type(node.op) in Defines.binary_operators:
+            left = Defines.evaluate_node(node.left, source)
+            right = Defines.evaluate_node(node.right, source)
+            if type(node.op) in (ast.LShift, ast.RShift) and not 0 <= right < 64:
+                raise AssertionError(f'Unable to evaluate {source}: shift by {right}')
+            if type(node.op) == ast.Div and right == 0:
+                raise AssertionError(f'Unable to evaluate {source}: division by 0')
+            return Defines.binary_operators[type(node.op)](left, right)
+        raise AssertionError(f'Unable to evaluate {source}: only integers and + - * / << >> & | ^ ~ are allowed')
+
+    def line_bytes(self, line):
+        # bytes of a line of comma separated defines and numbers like the ones in the tracks, !define = "db ..." is text
+        data = bytearray()
+        for item in line.split(','):
+            item = item.strip()
+            name = item[1:] if item.startswith('!') else None
+            if name != None and self.values.get(name, '').startswith('"'):
+                text = self.values[name].strip('"').strip()
+                if not text.startswith('db'):
+                    raise AssertionError(f'!{name} is not a db line')
+                data += self.line_bytes(text[2:])
+            else:
+                data.append(self.evaluate(item) & 0xFF)
+        return data
+
+class PJBinaryWriter():
+    # lays out the spcblocks of PJASMConverter.write as the N-SPC upload format:
+    # (size, address, data) per block, then 0 and the address to execute
+    def __init__(self, converter, defines: Defines):
+        self.converter = converter
+        self.defines = defines
+
+    def layout(self, prefix=''):
+        # encodes the tracks and gives an address to everything in the sample data block
+        converter = self.converter
+        self.p_sample_data = 0xB210-0x6E00+self.defines.value('p_sampleData')
+
+        # the tracks first, their sizes decide where everything after them goes
+        # fixups are (offset, label) of words that get the address of label, a subsection or 'NoteLengthTable'
+        use_custom_note_length_table = converter.note_length_table != Track.standard_note_length_table
+        first_track = next(iter(converter.tracker.patterns.values())).tracks[0]
+        self.tracks = {}
+        for pattern in converter.tracker.patterns.values():
+            for track in pattern.tracks:
+                if track != None and not track.label in self.tracks:
+                    self.tracks[track.label] = (track, *self.track_bytes(track, use_custom_note_length_table, prefix, track is first_track))
+        for subsection in converter.tracker.subsections().values():
+            self.tracks[subsection.label] = (subsection, *self.track_bytes(subsection))
+
+        self.addrs = {}
+        self.sample_addrs = {}
+        addr = self.p_sample_data
+        for label, sample in converter.sample_table.samples.items():
+            self.sample_addrs[label] = addr
+            addr += len(sample.data)
+        self.note_length_table_size = 0
+        if use_custom_note_length_table:
+            self.addrs['NoteLengthTable'] = addr
+            self.note_length_table_size = len(converter.note_length_table)
+            addr += self.note_length_table_size
+        self.p_trackers = addr+8 # padding for shared trackers
+        self.p_tracker = self.p_trackers+2
+        self.command_addrs = []
+        addr = self.p_tracker
+        for command in converter.tracker.commands:
+            self.command_addrs.append(addr)
+            addr += 2 if type(command[0]) == str else 4
+        self.loops = not (type(converter.tracker.commands[-1][0]) == str or converter.tracker.commands[-1][0] < 0x82)
+        if not self.loops:
+            addr += 2
+        for label in converter.tracker.patterns:
+            self.addrs[label] = addr
+            addr += 16
+        for label, (track, data, fixups) in self.tracks.items():
+            self.addrs[label] = addr
+            addr += len(data)
+        self.p_end = addr
+
+    def write(self, prefix=''):
+        converter = self.converter
+        self.layout(prefix)
+        if self.p_end > 0x10000:
+            raise AssertionError(f'Song data ends at ${self.p_end:04X}, past the end of ARAM')
+
+        addrs = self.addrs
+        data = bytearray()
+        for sample in converter.sample_table.samples.values():
+            data += sample.data
+        if self.note_length_table_size > 0:
+            data += bytes(converter.note_length_table)
+        data += bytes(8)
+        data += self.p_tracker.to_bytes(2, 'little')
+        for command in converter.tracker.commands:
+            if type(command[0]) == str:
+                data += addrs[command[0]].to_bytes(2, 'little')
+            else:
+                data += command[0].to_bytes(2, 'little') + self.command_addrs[command[1]].to_bytes(2, 'little')
+        if not self.loops:
+            data += bytes(2)
+        for pattern in converter.tracker.patterns.values():
+            for track in pattern.tracks:
+                data += (0 if track == None else addrs[track.label]).to_bytes(2, 'little')
+        for track, track_data, fixups in self.tracks.values():
+            for offset, key in fixups:
+                track_data[offset:offset+2] = addrs[key].to_bytes(2, 'little')
+            data += track_data
+
+        instr_table = bytearray()
+        for instr in converter.instr_table.instrs:
+            instr_table += bytes([converter.sample_map[instr[0]]] + instr[1:])
+        sample_table = bytearray()
+        for label in converter.sample_table.sample_labels:
+            p_sample = self.sample_addrs[label]
+            sample_table += p_sample.to_bytes(2, 'little') + (p_sample+converter.sample_table.samples[label].loop_point & 0xFFFF).to_bytes(2, 'little')
+
+        blocks = [
+            (6*0x16+self.defines.value('p_instrumentTable'), instr_table),
+            (4*0x16+self.defines.value('p_sampleTable'), sample_table),
+            (self.p_sample_data, data),
+            (self.defines.value('p_extra'), (self.p_trackers-8).to_bytes(2, 'little') + bytes(1))
+        ]
+        upload = bytearray()
+        for addr, block in blocks:
+            upload += len(block).to_bytes(2, 'little') + (addr & 0xFFFF).to_bytes(2, 'little') + block
+        upload += bytes(2) + self.defines.value('p_spcEngine').to_bytes(2, 'little')
+        return bytes(upload)
+
+    def track_bytes(self, track: Track, use_custom_note_length_table=False, prefix='', first=False):
+        # the bytes of Track.asm_lines, with (offset, key) of the addresses to fill in
+        converter = self.converter
+        instr_map = converter.instr_map
+        perc_base = converter.perc_base
+        first_perc = converter.first_perc
+        data = bytearray()
+        fixups = []
+
+        if first:
+            if prefix != '':
+                data += self.defines.line_bytes(prefix)
+            if track.dialect.game == 'thunderspirits':
+                spc = converter.spc
+                if spc.u8(0x1002C) == 0 and spc.u8(0x1003C) == 0: # EVOLL, EVOLR
+                    data.append(0xF6)
+                else:
+                    data += bytes([0xF5, spc.u8(0x1004D), spc.u8(0x1002C), spc.u8(0x1003C)]) # EON, EVOLL, EVOLR
+                    data += bytes([0xF7, spc.u8(0x1007D), spc.u8(0x1000D), [0x7F, 0x58, 0x0C, 0x34].index(spc.u8(0x1000F))]) # EDL, EFB, FIR0
+            if use_custom_note_length_table:
+                data += self.defines.line_bytes('!setNoteLengthTable')
+                fixups.append((len(data), 'NoteLengthTable'))
+                data += bytes(2)
+
+        for command in track.commands:
+            op = command[0]
+            if op < 0xCA:
+                data += bytes(b & 0xFF for b in command)
+            elif op < 0xE0:
+                data.append(0xCA+instr_map[op-0xCA+perc_base]-instr_map[first_perc])
+            elif op == 0xE0:
+                instr = command[1]-0xCA+perc_base if command[1] >= 0xCA else command[1]
+                data += bytes([0xE0, instr_map[instr]])
+            elif op == 0xEF:
+                data.append(0xEF)
+                fixups.append((len(data), command[1].label))
+                data += bytes([0, 0, command[2] & 0xFF])
+            elif op == 0xF9:
+                data += bytes([0xF9, command[1] & 0xFF, command[2] & 0xFF, 0x80+(command[3] & 0x7F)])
+            elif op == 0xFA:
+                if first_perc != None:
+                    data += bytes([0xFA, instr_map[first_perc]])
+            elif op < 0x100:
+                data += bytes(b & 0xFF for b in command)
+            else:
+                # custom commands only have names, their bytes come from the defines
+                line = track.dialect.formatter.table[op](command, perc_base, first_perc)
+                data += self.defines.line_bytes(line.strip())
+        data.append(0) # !end
+        return data, fixups
@@ -0,0 +1,172 @@
+from array import array
+import wave
+
+# BRR decoding as done by the S-DSP: every 9 byte block has a header (shift << 4 | filter << 2 | loop << 1 | end)
+# followed by 16 4-bit samples, high nibble first
+
+def nibble_pairs(shift):
+    # data byte -> its 2 samples after shifting, before filtering
+    pairs = []
+    for byte in range(0x100):
+        pair = []
+        for nibble in (byte >> 4, byte & 0xF):
+            s = nibble-0x10 if nibble >= 8 else nibble
+            if shift <= 12:
+                s = (s << shift) >> 1
+            else:
+                s = -0x800 if s < 0 else 0
+            pair.append(s)
+        pairs.append(tuple(pair))
+    return pairs
+
+shifted = [nibble_pairs(shift) for shift in range(0x10)]
+
+# blocks using filter 0 don't depend on earlier samples, so their output is a lookup
+unfiltered = [[tuple(((s << 1) & 0xFFFF) - (0x10000 if (s << 1) & 0x8000 else 0) for s in pair) for pair in pairs] for pairs in shifted]
+
+def decode_blocks(data, blocks, pcm, p1=0, p2=0):
+    # appends the samples of the blocks (indices into data) to pcm, returns the last two samples for the next blocks
+    for block in blocks:
+        start = block*9
+        header = data[start]
+        shift = header >> 4
+        filter = header >> 2 & 3
+        if filter == 0:
+            table = unfiltered[shift]
+            for byte in data[start+1:start+9]:
+                pcm.extend(table[byte])
+            p1 = pcm[-1]
+            p2 = pcm[-2]
+            continue
+
+        # the DSP keeps the second to last sample at half precision
+        table = shifted[shift]
+        for byte in data[start+1:start+9]:
+            for s in table[byte]:
+                if filter == 1:
+                    s += (p1 >> 1) + ((-p1) >> 5)
+                elif filter == 2:
+                    s += p1 - (p2 >> 1) + (p2 >> 5) + ((p1*-3) >> 6)
+                else:
+                    s += p1 - (p2 >> 1) + ((p1*-13) >> 7) + (((p2 >> 1)*3) >> 4)
+                if s > 0x7FFF:
+                    s = 0x7FFF
+                elif s < -0x8000:
+                    s = -0x8000
+                # stored doubled in 16 bits, so the top bit is lost
+                s = (s << 1) & 0xFFFF
+                if s & 0x8000:
+                    s -= 0x10000
+                pcm.append(s)
+                p2 = p1
+                p1 = s
+    return p1, p2
+
+def decode(data, loop_point=0, loop=False, loops=0):
+    # returns the samples of BRR data as signed 16-bit PCM, with the looped part played loops more times
+    pcm = array('h')
+    n_blocks = len(data)//9
+    p1, p2 = decode_blocks(data, range(n_blocks), pcm)
+    if loop and loops > 0 and 0 <= loop_point < len(data):
+        loop_blocks = range(loop_point//9, n_blocks)
+        for _ in range(loops):
+            p1, p2 = decode_blocks(data, loop_blocks, pcm, p1, p2)
+    return pcm
+
+def write_wav(fp, pcm, rate=32000):
+    # fp is a filepath or a binary file object, 32 kHz is what the DSP plays at pitch $1000
+    with wave.open(fp, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(rate)
+        file.writeframes(pcm.tobytes())
+
+def predict(filter, p1, p2):
+    # the part of a sample the filter adds, as decode_blocks does it
+    if filter == 1:
+        return (p1 >> 1) + ((-p1) >> 5)
+    elif filter == 2:
+        return p1 - (p2 >> 1) + (p2 >> 5) + ((p1*-3) >> 6)
+    elif filter == 3:
+        return p1 - (p2 >> 1) + ((p1*-13) >> 7) + (((p2 >> 1)*3) >> 4)
+    return 0
+
+def encode_block(pcm, filter, shift, p1, p2):
+    # returns the nibbles, their squared error and the last two decoded samples
+    nibbles = []
+    error = 0
+    for target in pcm:
+        prediction = predict(filter, p1, p2)
+        # the decoded sample is 2*((n << shift) >> 1 + prediction), so n is about (target-2*prediction) >> shift
+        n = round((target-2*prediction)/(1 << shift))
+        n = -8 if n < -8 else 7 if n > 7 else n
+        while True:
+            s = ((n << shift) >> 1)+prediction
+            s = 0x7FFF if s > 0x7FFF else -0x8000 if s < -0x8000 else s
+            # doubling wraps past 16 bits, so stay away from it
+            if s > 0x3FFF and n > -8:
+                n -= 1
+            elif s < -0x4000 and n < 7:
+                n += 1
+            else:
+                break
+        s = (s << 1) & 0xFFFF
+        if s & 0x8000:
+            s -= 0x10000
+        nibbles.append(n & 0xF)
+        error += (s-target)*(s-target)
+        p2 = p1
+        p1 = s
+    return nibbles, error, p1, p2
+
+def encode(pcm, loop_start=None):
+    # signed 16-bit PCM, a multiple of 16 samples long, to BRR trying every filter and shift for each block
+    # loop_start is the sample the loop starts at, a multiple of 16, its block uses filter 0 so it doesn't depend on the end of the loop
+    data = bytearray()
+    p1 = p2 = 0
+    n_blocks = len(pcm)//16
+    for block in range(n_blocks):
+        samples = pcm[block*16:block*16+16]
+        filters = (0,) if block == 0 or (loop_start != None and block == loop_start//16) else range(4)
+        best = None
+        for filter in filters:
+            for shift in range(13):
+                candidate = encode_block(samples, filter, shift, p1, p2)
+                if best == None or candidate[1] < best[2][1]:
+                    best = (filter, shift, candidate)
+                if candidate[1] == 0:
+                    break
+        filter, shift, (nibbles, error, p1, p2) = best
+        header = shift << 4 | filter << 2
+        if block == n_blocks-1:
+            header |= 1 | (2 if loop_start != None else 0)
+        data.append(header)
+        for i in range(0, 16, 2):
+            data.append(nibbles[i] << 4 | nibbles[i+1])
+    return data
+
+def resample(pcm, length, loop_start=None, new_loop_start=None):
+    # pcm stretched to length samples by linear interpolation, a looping sample keeps looping smoothly:
+    # the part before the loop and the loop are stretched separately, reading past the end wraps to loop_start
+    out = array('h')
+    n = len(pcm)
+    if n == 0:
+        return array('h', bytes(2*length))
+    def at(i):
+        if i < n:
+            return pcm[i]
+        if loop_start == None:
+            return 0
+        return pcm[loop_start+(i-loop_start) % (n-loop_start)]
+    for i in range(length):
+        if loop_start == None:
+            x = i*n/length
+        elif i < new_loop_start:
+            x = i*loop_start/new_loop_start
+        else:
+            x = loop_start+(i-new_loop_start)*(n-loop_start)/(length-new_loop_start)
+        j = int(x)
+        t = x-j
+        s = round(at(j)*(1-t)+at(j+1)*t)
+        out.append(0x7FFF if s > 0x7FFF else -0x8000 if s < -0x8000 else s)
+    return out
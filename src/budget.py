@@ -0,0 +1,102 @@
+from src.binary import Defines, PJBinaryWriter
+import json
+
+class ARAMMap():
+    # the ARAM each spcblock may use, as (start, end) asar expressions of the engine defines, end is exclusive
+    # the defaults only stop blocks from running into the next table or past the end of ARAM,
+    # an engine with an echo buffer or code after the songs needs its own map
+    default_regions = {
+        'instrument_table': ('6*$16+!p_instrumentTable', '6*$100+!p_instrumentTable'),
+        'sample_table': ('4*$16+!p_sampleTable', '4*$100+!p_sampleTable'),
+        'sample_data': ('$B210-$6E00+!p_sampleData', '$10000'),
+        'extra': ('!p_extra', '!p_extra+3')
+    }
+
+    def __init__(self, defines: Defines, regions=None):
+        # regions overrides some of the default regions, values are expressions or numbers
+        self.regions = {}
+        for name, (start, end) in (ARAMMap.default_regions | ({} if regions == None else regions)).items():
+            self.regions[name] = tuple(bound if type(bound) == int else defines.evaluate(bound) for bound in (start, end))
+
+    def load(path, defines: Defines):
+        # a JSON object of region name: [start, end]
+        with open(path, 'r') as file:
+            return ARAMMap(defines, json.load(file))
+
+class ARAMBudget():
+    # the exact size of every emitted block and what it's made of, checked against an ARAMMap before anything is written
+    def __init__(self, converter, defines: Defines, aram_map: ARAMMap=None, prefix=''):
+        self.converter = converter
+        self.aram_map = ARAMMap(defines) if aram_map == None else aram_map
+        self.writer = PJBinaryWriter(converter, defines)
+        self.writer.layout(prefix)
+
+    def sizes(self):
+        # bytes of everything in the blocks, by block, then by label
+        converter = self.converter
+        writer = self.writer
+        tracks = {}
+        subsections = {}
+        for label, (track, data, fixups) in writer.tracks.items():
+            (subsections if track.is_subroutine else tracks)[label] = len(data)
+        return {
+            'instrument_table': {f'instr{i:02X}': 6 for i in converter.instr_map},
+            'sample_table': {label: 4 for label in converter.sample_table.sample_labels},
+            'sample_data': {
+                'samples': {label: len(sample.data) for label, sample in converter.sample_table.samples.items()},
+                'NoteLengthTable': writer.note_length_table_size,
+                'padding': 8,
+                'Trackers': 2,
+                'tracker': writer.addrs[next(iter(converter.tracker.patterns))]-writer.p_tracker,
+                'patterns': {label: 16 for label in converter.tracker.patterns},
+                'tracks': tracks,
+                'subsections': subsections
+            },
+            'extra': {'Trackers-8': 2, 'padding': 1}
+        }
+
+    def blocks(self):
+        # {block: (start, size)}, the same blocks as PJASMConverter.write
+        converter = self.converter
+        writer = self.writer
+        return {
+            'instrument_table': (6*0x16+writer.defines.value('p_instrumentTable'), 6*len(converter.instr_table.instrs)),
+            'sample_table': (4*0x16+writer.defines.value('p_sampleTable'), 4*len(converter.sample_table.sample_labels)),
+            'sample_data': (writer.p_sample_data, writer.p_end-writer.p_sample_data),
+            'extra': (writer.defines.value('p_extra'), 3)
+        }
+
+    def report(self, name=''):
+        # a JSON-able dict, headroom is negative by how much a block overflows its region
+        blocks = {}
+        for block, (start, size) in self.blocks().items():
+            region_start, region_end = self.aram_map.regions[block]
+            blocks[block] = {
+                'start': start,
+                'size': size,
+                'end': start+size,
+                'region_start': region_start,
+                'region_end': region_end,
+                'headroom': region_end-(start+size),
+                'fits': region_start <= start and start+size <= region_end
+            }
+        return {
+            'name': name,
+            'fits': all(block['fits'] for block in blocks.values()),
+            'blocks': blocks,
+            'sizes': self.sizes()
+        }
+
+    def overflows(report):
+        # messages for the blocks of a report that don't fit
+        messages = []
+        for block, entry in report['blocks'].items():
+            if entry['start'] < entry['region_start']:
+                messages.append(f'{block} starts at ${entry['start']:04X}, before ${entry['region_start']:04X}')
+            if entry['headroom'] < 0:
+                messages.append(f'{block} overflows by {-entry['headroom']} bytes (ends at ${entry['end']:04X}, past ${entry['region_end']:04X})')
+        return messages
+
+    def write_json(reports, path):
+        with open(path, 'w') as file:
+            json.dump({'songs': reports, 'fits': sum(report['fits'] for report in reports), 'overflows': sum(not report['fits'] for report in reports)}, file, indent=1)
@@ -0,0 +1,313 @@
+from src.spcfile import SPCFile
+from src.api import ConversionOptions, ConversionResult, extract
+from src.cache import BulkCache
+from src.bank import SharedBank
+from src.binary import Defines, PJBinaryWriter
+from src.budget import ARAMMap, ARAMBudget
+from src.profiler import Profiler
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import cProfile, glob, io, os.path, posixpath, tarfile, time, zipfile
+
+archive_extensions = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+def is_archive(path):
+    return path.lower().endswith(archive_extensions)
+
+class SPCSource():
+    # an SPC to convert, a file or the bytes of an archive member
+    def __init__(self, name, path=None, data=None):
+        self.name = name
+        self.path = path
+        self.data = data
+
+    def read(self):
+        if self.data != None:
+            return self.data
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def spc_file(self):
+        return SPCFile(self.path if self.data == None else self.data)
+
+def spc_sources(path):
+    # the SPCs of a folder, or of a zip or tar archive read in one pass, sorted by name
+    if not os.path.exists(path):
+        raise AssertionError(f'{path} doesn\'t exist')
+    if os.path.isdir(path):
+        return [SPCSource(os.path.split(spc_path)[1], path=spc_path) for spc_path in sorted(glob.glob(os.path.join(path, '*.spc')))]
+
+    members = [] # (path in the archive, data)
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.spc'):
+                    members.append((info.filename, archive.read(info)))
+    elif tarfile.is_tarfile(path):
+        # a stream, so compressed tars are read front to back once
+        with tarfile.open(path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith('.spc'):
+                    members.append((member.name, archive.extractfile(member).read()))
+    else:
+        raise AssertionError(f'{path} is neither a folder nor a zip or tar archive')
+
+    # members are named by their filename, unless two folders of the archive have the same one
+    # ./x/a.spc and x/a.spc are the same path
+    members = [(posixpath.normpath(member_path).lstrip('/'), data) for member_path, data in members]
+    filenames = [member_path.split('/')[-1] for member_path, data in members]
+    sources = []
+    for filename, (member_path, data) in zip(filenames, members):
+        name = filename if filenames.count(filename) == 1 else member_path.replace('/', '_')
+        sources.append(SPCSource(name, data=data))
+    return sorted(sources, key=lambda source: source.name)
+
+class BulkOutput():
+    # where a worker puts the files of one SPC: a folder, or the result itself to be written to an archive by the main process
+    def __init__(self, path):
+        self.archive = is_archive(path)
+        self.fp = (os.path.split(path)[0] or '.') if self.archive else path
+
+    @contextmanager
+    def open(self, result, filename, binary=False):
+        if self.archive:
+            file = io.BytesIO() if binary else io.StringIO()
+            yield file
+            result.files[filename] = file.getvalue() if binary else file.getvalue().encode()
+            result.outputs.append(filename)
+            return
+        path = os.path.join(self.fp, filename)
+        with open(path, 'wb' if binary else 'w') as file:
+            yield file
+        result.outputs.append(path)
+
+    def write_samples(self, result, sample_table, wavs=False):
+        # hash named, like the incbins of the ASM expect
+        if not self.archive:
+            result.outputs += sample_table.samples_to_wavs(self.fp, hash_option=True) if wavs else sample_table.samples_to_files(self.fp, hash_option=True)
+            return
+        for filename, data in sample_table.wav_files(hash_option=True) if wavs else sample_table.sample_files(hash_option=True):
+            result.files[filename] = data
+            result.outputs.append(filename)
+
+class OutputArchive():
+    # the outputs of a bulk conversion written in one pass, files with the same name (shared samples) are written once
+    def __init__(self, path):
+        self.names = set()
+        if path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            self.tar = None
+        else:
+            compression = {'.gz': 'gz', '.tgz': 'gz', '.bz2': 'bz2', '.tbz2': 'bz2', '.xz': 'xz', '.txz': 'xz'}.get(os.path.splitext(path.lower())[1], '')
+            self.zip = None
+            self.tar = tarfile.open(path, 'w:' + compression)
+
+    def write(self, name, data):
+        if name in self.names:
+            return
+        self.names.add(name)
+        if self.zip != None:
+            self.zip.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(data))
+
+    def write_result(self, result):
+        for name, data in result.files.items():
+            self.write(name, data)
+        # no need to keep them once written
+        result.files = {}
+
+    def close(self):
+        (self.zip if self.zip != None else self.tar).close()
+
+class BulkResult():
+    def __init__(self, source: SPCSource):
+        self.source = source
+        self.name = source.name
+        self.success = False
+        self.cached = False
+        self.outputs = []
+        self.files = {} # filename -> data of outputs that go to an archive
+        self.messages = []
+        self.error = None
+        self.profile = None
+        self.game = None
+        self.bank_entry = None
+        self.budget = None
+
+def convert_spc(source: SPCSource, args, bank: SharedBank=None):
+    # runs in a worker process, so every exception is turned into a result instead of escaping
+    result = BulkResult(source)
+    profiler = Profiler(result.name, enabled=args.profile)
+    try:
+        if args.cprofile == result.name:
+            cprofiler = cProfile.Profile()
+            cprofiler.runcall(convert_spc_profiled, source, args, result, profiler, bank)
+            cprofiler.dump_stats(os.path.join(BulkOutput(args.asm).fp, os.path.splitext(result.name)[0] + '.prof'))
+        else:
+            convert_spc_profiled(source, args, result, profiler, bank)
+        result.success = True
+    except Exception as e:
+        result.error = repr(e)
+    if args.profile:
+        result.profile = profiler
+    return result
+
+def gather_spc(source: SPCSource, args):
+    # first pass of a conversion to a shared bank, the instruments and samples of the SPC as result.bank_entry
+    result = BulkResult(source)
+    try:
+        converter = extract_spc(source, args, result, Profiler(enabled=False))
+        result.bank_entry = SharedBank.entry(converter)
+        result.success = True
+    except Exception as e:
+        result.error = repr(e)
+    return result
+
+def extract_spc(source: SPCSource, args, result, profiler):
+    with profiler.stage('read'):
+        spc = source.spc_file()
+    conversion = ConversionResult(result.name)
+    try:
+        return extract(spc, ConversionOptions.from_args(args), conversion, profiler)
+    finally:
+        # also when extracting fails, a wrong detection is often why
+        if conversion.detected_game != None:
+            result.messages.append(f'detected game: {conversion.detected_game}')
+        result.messages += conversion.warnings
+        result.game = conversion.game
+
+def convert_spc_profiled(source: SPCSource, args, result, profiler, bank: SharedBank=None):
+    converter = extract_spc(source, args, result, profiler)
+    output = BulkOutput(args.asm)
+    if args.binary or args.budget or args.reject_overflow:
+        defines = Defines().parse(os.path.join(output.fp, args.defines_fp))
+    if (args.budget or args.reject_overflow) and bank == None:
+        # sized before anything is written, so a song that doesn't fit costs no output
+        with profiler.stage('budget'):
+            result.budget = ARAMBudget(converter, defines, None if args.aram_map == None else ARAMMap.load(args.aram_map, defines), args.prefix).report(result.name)
+        overflows = ARAMBudget.overflows(result.budget)
+        result.messages += overflows
+        if args.reject_overflow and len(overflows) > 0:
+            raise AssertionError('Song doesn\'t fit in ARAM')
+
+    name = os.path.splitext(result.name)[0]
+    with profiler.stage('emit'):
+        if args.binary:
+            with output.open(result, name + '.bin', binary=True) as file:
+                file.write(PJBinaryWriter(converter, defines).write(args.prefix))
+        if not args.binary or args.debug_asm:
+            with output.open(result, name + '.asm') as asm:
+                if bank != None:
+                    converter.instr_map = bank.instr_maps[result.name]
+                    converter.write_banked(asm, args.defines_fp, SharedBank.filename, args.prefix, instr_defines=True)
+                else:
+                    converter.write(asm, args.defines_fp, args.export_samples, args.prefix)
+    if args.compress:
+        result.messages.append(f'tracks compressed from {converter.sequence_sizes[0]} to {converter.sequence_sizes[1]} bytes')
+    if args.dedup_samples and len(converter.sample_merges) > 0:
+        result.messages.append(f'merged {len(converter.sample_merges)} samples, saving {converter.sample_bytes_saved} bytes')
+    if len(converter.sample_fit) > 0:
+        result.messages.append('fitted samples ' + ', '.join(f'{label} by {fit['ratio']:.3f}' for label, fit in converter.sample_fit.items()))
+    if bank != None:
+        # the samples are exported with the bank
+        return
+
+    if args.export_samples:
+        with profiler.stage('export'):
+            output.write_samples(result, converter.sample_table)
+    if args.export_wavs:
+        with profiler.stage('wav'):
+            output.write_samples(result, converter.sample_table, wavs=True)
+
+def convert_bulk(sources, args, jobs=1, cache: BulkCache=None, bank: SharedBank=None):
+    # yields one BulkResult per SPCSource, in the same order as sources
+    # with a cache, SPCs converted before with the same options are skipped
+    # with a bank, the instruments and samples of every SPC are gathered into it first, then written to SharedBank.filename
+    if bank != None:
+        yield from convert_bulk_shared(sources, args, jobs, bank)
+        return
+    keys = {}
+    cached_results = {}
+    if cache != None:
+        files_key = cache.files_key(args)
+        for source in sources:
+            result = BulkResult(source)
+            keys[source.name] = BulkCache.key(source.read(), args, files_key)
+            outputs = cache.lookup(result.name, keys[source.name])
+            if outputs != None:
+                result.success = True
+                result.cached = True
+                result.outputs = outputs
+                cached_results[source.name] = result
+    to_convert = [source for source in sources if not source.name in cached_results]
+
+    if jobs == 1 or len(to_convert) <= 1:
+        converted = (convert_spc(source, args) for source in to_convert)
+        yield from merge_results(sources, cached_results, converted, cache, keys)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs if jobs > 0 else None) as executor:
+            converted = executor.map(convert_spc, to_convert, [args]*len(to_convert))
+            yield from merge_results(sources, cached_results, converted, cache, keys)
+
+    if cache != None:
+        cache.prune({source.name for source in sources})
+        cache.save()
+
+def merge_results(sources, cached_results, converted, cache, keys):
+    for source in sources:
+        if source.name in cached_results:
+            yield cached_results[source.name]
+            continue
+        result = next(converted)
+        if cache != None:
+            if result.success:
+                cache.store(result.name, keys[source.name], result.outputs)
+            else:
+                cache.forget(result.name)
+        yield result
+
+def convert_bulk_shared(sources, args, jobs, bank: SharedBank):
+    # the bank depends on every SPC, so nothing is cached
+    if jobs == 1 or len(sources) <= 1:
+        gathered = [gather_spc(source, args) for source in sources]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs if jobs > 0 else None) as executor:
+            gathered = list(executor.map(gather_spc, sources, [args]*len(sources)))
+
+    # added in input order, so the IDs don't depend on which worker finished first
+    to_convert = []
+    for result in gathered:
+        if result.success:
+            bank.add(result.name, result.bank_entry)
+            to_convert.append(result.source)
+    output = BulkOutput(args.asm)
+    bank_result = BulkResult(SPCSource(SharedBank.filename))
+    with output.open(bank_result, SharedBank.filename) as file:
+        bank.write(file, args.export_samples)
+    if args.export_samples:
+        output.write_samples(bank_result, bank.sample_table)
+    if args.export_wavs:
+        output.write_samples(bank_result, bank.sample_table, wavs=True)
+
+    if jobs == 1 or len(to_convert) <= 1:
+        converted = (convert_spc(source, args, bank) for source in to_convert)
+        yield from merge_shared_results(gathered, converted, bank_result)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs if jobs > 0 else None) as executor:
+            converted = executor.map(convert_spc, to_convert, [args]*len(to_convert), [bank]*len(to_convert))
+            yield from merge_shared_results(gathered, converted, bank_result)
+
+def merge_shared_results(gathered, converted, bank_result):
+    for result in gathered:
+        if not result.success:
+            yield result
+            continue
+        result = next(converted)
+        if result.success:
+            result.outputs += bank_result.outputs
+            result.files.update(bank_result.files)
+        yield result
@@ -0,0 +1,86 @@
+from src.binary import Defines
+import hashlib, json, os, os.path
+
+class BulkCache():
+    # bump whenever the generated ASM or samples change, so old caches are thrown away
+    converter_version = 1
+    filename = 'nspc_cache.json'
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.path = os.path.join(fp, self.filename)
+        self.entries = {}
+        self.stale_outputs = set()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def key(spc_data, args, files_key=''):
+        # everything that affects the output of one SPC, files_key is files_key(args) of the run
+        options = [BulkCache.converter_version, args.game, args.amplify, args.prefix, args.defines_fp, args.export_samples, args.export_wavs, args.dedup_samples, args.sample_tolerance, args.compress, args.subloop_subsections, args.binary, args.debug_asm, args.aram_map, args.reject_overflow, args.sample_budget, args.sample_ratio, args.min_sample_ratio, files_key]
+        h = hashlib.sha256(spc_data)
+        h.update(json.dumps(options).encode())
+        return h.hexdigest()
+
+    def files_key(self, args):
+        # the contents of the defines, the files they incsrc and the ARAM map, the binary output and the budget depend on them
+        h = hashlib.sha256()
+        defines = Defines()
+        try:
+            defines.parse(os.path.join(self.fp, args.defines_fp))
+        except OSError:
+            h.update(b'missing defines')
+        paths = defines.paths + ([] if args.aram_map == None else [args.aram_map])
+        for path in paths:
+            h.update(path.encode() + b'\0')
+            try:
+                with open(path, 'rb') as file:
+                    h.update(hashlib.sha256(file.read()).digest())
+            except OSError:
+                h.update(b'missing')
+        return h.hexdigest()
+
+    def lookup(self, name, key):
+        # returns the output paths of an up to date conversion, or None
+        entry = self.entries.get(name)
+        if entry == None or entry['key'] != key:
+            return None
+        outputs = [os.path.join(self.fp, output) for output in entry['outputs']]
+        if not all(os.path.exists(output) for output in outputs):
+            return None
+        return outputs
+
+    def store(self, name, key, outputs):
+        self.forget(name)
+        self.entries[name] = {'key': key, 'outputs': [os.path.relpath(output, self.fp) for output in outputs]}
+
+    def forget(self, name):
+        if name in self.entries:
+            self.stale_outputs.update(self.entries.pop(name)['outputs'])
+
+    def prune(self, names):
+        # forget SPCs that aren't in the input anymore and delete outputs nothing refers to
+        for name in list(self.entries):
+            if not name in names:
+                self.forget(name)
+
+        used_outputs = set()
+        for entry in self.entries.values():
+            used_outputs.update(entry['outputs'])
+        removed = []
+        for output in sorted(self.stale_outputs - used_outputs):
+            path = os.path.join(self.fp, output)
+            if os.path.exists(path):
+                os.remove(path)
+                removed.append(path)
+        self.stale_outputs = set()
+        return removed
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.entries, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
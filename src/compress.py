@@ -0,0 +1,156 @@
+from src.track import Track, Tracker, CommandList
+
+class SequenceCompressor():
+    # factors runs of commands repeated across the tracks of a tracker into subsections called with !loop
+    # subsections can't call subsections, so only tracks are searched and a run never contains a subsection call
+    call_size = 4 # EF pppp cc
+
+    def __init__(self, tracker: Tracker, max_run_length=64):
+        self.tracker = tracker
+        self.max_run_length = max_run_length
+        self.subsection_count = 0
+
+    def compress(self):
+        # rewrites the tracks in place, returns the size of all tracks and subsections in bytes before and after
+        tracks = [track for track in self.tracker.tracks_and_subsections() if not track.is_subroutine]
+        size_before = sum(track.byte_size() for track in self.tracker.tracks_and_subsections())
+
+        # commands are replaced by integer tokens, unique tokens for commands that can't be in a run
+        token_ids = {}
+        self.commands = [] # token -> command
+        self.sizes = [] # token -> size in bytes
+        self.matchable = [] # token -> whether it can be in a run
+        seqs = []
+        for track in tracks:
+            seq = []
+            for command in track.commands:
+                if command[0] in (0xEF, 0x1E6):
+                    seq.append(self.new_token(command, False))
+                else:
+                    token = token_ids.get(command)
+                    if token == None:
+                        token = token_ids[command] = self.new_token(command, True)
+                    seq.append(token)
+            seqs.append(seq)
+
+        while True:
+            replacements = self.pick_runs(seqs)
+            if len(replacements) == 0:
+                break
+            seqs = [self.replace(seq, replacements.get(t, [])) for t, seq in enumerate(seqs)]
+
+        for track, seq in zip(tracks, seqs):
+            track.commands = CommandList(self.commands[token] for token in seq)
+        size_after = sum(track.byte_size() for track in self.tracker.tracks_and_subsections())
+        return size_before, size_after
+
+    def new_token(self, command, matchable):
+        self.commands.append(command)
+        self.sizes.append(SequenceCompressor.call_size if command[0] == 0xEF else len(command))
+        self.matchable.append(matchable)
+        return len(self.commands)-1
+
+    def can_end_run(self, token):
+        # a note length without a volume byte would read the terminator of the subsection as its volume
+        command = self.commands[token]
+        return not (command[0] < 0x80 and len(command) == 1)
+
+    def is_slide(self, token):
+        return self.commands[token][0] == 0xF9
+
+    def splits_slide(self, seq, end):
+        # the engine only reads a pitch slide right after a note (or another slide), so a note and the slides after it
+        # are one unit that a run can't end in the middle of
+        if end >= len(seq) or not self.is_slide(seq[end]):
+            return False
+        op = self.commands[seq[end-1]][0]
+        return 0x80 <= op < 0xE0 or op == 0xF9
+
+    def candidates(self, seqs):
+        # every run that occurs at least twice, as (length, positions), found by refining groups of equal runs one command at a time
+        # runs don't start with a pitch slide, and occurrences that would leave the slides of their last note behind are left out
+        groups = {}
+        for t, seq in enumerate(seqs):
+            for i, token in enumerate(seq):
+                if self.matchable[token] and not self.is_slide(token):
+                    groups.setdefault(token, []).append((t, i))
+        groups = [positions for positions in groups.values() if len(positions) >= 2]
+
+        n = 1
+        while len(groups) > 0 and n <= self.max_run_length:
+            next_groups = []
+            for positions in groups:
+                t, i = positions[0]
+                if self.can_end_run(seqs[t][i+n-1]):
+                    ends = [(t, i) for t, i in positions if not self.splits_slide(seqs[t], i+n)]
+                    if len(ends) >= 2:
+                        yield n, ends
+
+                extended = {}
+                for t, i in positions:
+                    if i+n < len(seqs[t]) and self.matchable[seqs[t][i+n]]:
+                        extended.setdefault(seqs[t][i+n], []).append((t, i))
+                next_groups += [positions for positions in extended.values() if len(positions) >= 2]
+            groups = next_groups
+            n += 1
+
+    def savings(self, n, run_size, positions):
+        # bytes saved by calling a subsection at positions, adjacent occurrences are one call repeating it
+        calls = 0
+        previous = None
+        for t, i in positions:
+            if previous != (t, i-n):
+                calls += 1
+            previous = (t, i)
+        return len(positions)*run_size - (run_size+1) - calls*SequenceCompressor.call_size
+
+    def pick_runs(self, seqs):
+        # the most saving runs whose occurrences don't overlap, returns {track index: [(start, length, subsection)]}
+        scored = []
+        for n, positions in self.candidates(seqs):
+            t, i = positions[0]
+            run_size = sum(self.sizes[token] for token in seqs[t][i:i+n])
+            # upper bound, as if every occurrence was a separate call
+            if len(positions)*run_size - (run_size+1) - len(positions)*SequenceCompressor.call_size > 0:
+                scored.append((len(positions)*(run_size-SequenceCompressor.call_size)-run_size, n, run_size, positions))
+        scored.sort(key=lambda candidate: -candidate[0])
+
+        used = [bytearray(len(seq)) for seq in seqs]
+        replacements = {}
+        for _, n, run_size, positions in scored:
+            chosen = []
+            for t, i in sorted(positions):
+                if (len(chosen) == 0 or chosen[-1][0] != t or chosen[-1][1]+n <= i) and not any(used[t][i:i+n]):
+                    chosen.append((t, i))
+            if len(chosen) < 2 or self.savings(n, run_size, chosen) <= 0:
+                continue
+
+            t, i = chosen[0]
+            subsection = Track(label=f'.compressed{self.subsection_count}')
+            self.subsection_count += 1
+            subsection.is_subroutine = True
+            subsection.dialect = self.tracker.dialect
+            subsection.commands = CommandList(self.commands[token] for token in seqs[t][i:i+n])
+            self.tracker.subsections()[subsection.label] = subsection
+            for t, i in chosen:
+                used[t][i:i+n] = b'\1'*n
+                replacements.setdefault(t, []).append((i, n, subsection))
+        return replacements
+
+    def replace(self, seq, replacements):
+        # replaces runs by subsection calls, back to back occurrences of a subsection become one call, up to 255 times
+        starts = {i: (n, subsection) for i, n, subsection in replacements}
+        new_seq = []
+        i = 0
+        while i < len(seq):
+            if not i in starts:
+                new_seq.append(seq[i])
+                i += 1
+                continue
+            n, subsection = starts[i]
+            count = 0
+            while i in starts and starts[i][1] is subsection and count < 0xFF:
+                count += 1
+                i += n
+            new_seq.append(self.new_token((0xEF, subsection, count), False))
+        return new_seq
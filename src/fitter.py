@@ -0,0 +1,95 @@
+from src.instr import BRRSample, SampleTable, InstrTable
+from src import brr
+import math
+
+class SampleFitter():
+    # shrinks the samples of a song until their BRR data fits in a budget:
+    # trailing silence of samples that don't loop is cut first, then the largest sample is resampled by ratio
+    # again and again, down to min_ratio, and the instruments playing it are retuned to keep their pitch
+    def __init__(self, sample_table: SampleTable, instr_table: InstrTable, sample_merges=None):
+        self.sample_table = sample_table
+        self.instr_table = instr_table
+        self.sample_merges = {} if sample_merges == None else sample_merges
+        self.ratios = {} # label -> ratio the sample is resampled by
+        self.originals = {} # label -> (pcm, loop start in samples or None) before fitting
+        self.done = set() # labels that can't get any smaller
+
+    def size(self):
+        return sum(len(sample.data) for sample in self.sample_table.samples.values())
+
+    def fit(self, budget, ratio=0.75, min_ratio=0.25):
+        # returns {label: {'ratio', 'bytes_before', 'bytes_after'}} of the samples that changed
+        sizes_before = {label: len(sample.data) for label, sample in self.sample_table.samples.items()}
+        if self.size() > budget:
+            for label, sample in self.sample_table.samples.items():
+                self.truncate(sample)
+
+        while self.size() > budget:
+            candidates = [label for label, sample in self.sample_table.samples.items() if not label in self.done and self.ratios.get(label, 1.0)*ratio >= min_ratio]
+            if len(candidates) == 0:
+                break
+            label = max(candidates, key=lambda label: len(self.sample_table.samples[label].data))
+            self.resample(label, self.ratios.get(label, 1.0)*ratio)
+
+        self.retune(self.ratios)
+
+        report = {}
+        for label, sample in self.sample_table.samples.items():
+            if len(sample.data) != sizes_before[label]:
+                report[label] = {'ratio': self.ratios.get(label, 1.0), 'bytes_before': sizes_before[label], 'bytes_after': len(sample.data)}
+        return report
+
+    def truncate(self, sample: BRRSample):
+        # blocks after the last one making a sound don't matter if the sample doesn't loop
+        if sample.loop:
+            return
+        pcm = sample.decode()
+        n = len(pcm)
+        while n > 0 and pcm[n-1] == 0:
+            n -= 1
+        n_blocks = max(1, math.ceil(n/16))
+        if n_blocks*9 < len(sample.data):
+            sample.data = sample.data[:n_blocks*9]
+            sample.data[-9] |= 1 # end
+
+    def resample(self, label, ratio):
+        # always from the original audio, so resampling again doesn't add up errors
+        sample = self.sample_table.samples[label]
+        if not label in self.originals:
+            self.originals[label] = (sample.decode(), sample.loop_point//9*16 if sample.loop else None)
+        pcm, loop_start = self.originals[label]
+        if len(pcm) == 0 or (loop_start != None and loop_start >= len(pcm)):
+            self.done.add(label)
+            return
+
+        if loop_start == None:
+            length = max(16, math.ceil(len(pcm)*ratio/16)*16)
+            actual_ratio = length/len(pcm)
+            new_loop_start = None
+        else:
+            # the loop and the part before it are whole blocks, the loop length decides the actual ratio
+            loop_length = max(16, round((len(pcm)-loop_start)*ratio/16)*16)
+            actual_ratio = loop_length/(len(pcm)-loop_start)
+            new_loop_start = round(loop_start*actual_ratio/16)*16
+            length = new_loop_start+loop_length
+        if actual_ratio >= self.ratios.get(label, 1.0):
+            self.done.add(label)
+            return
+
+        sample.data = brr.encode(brr.resample(pcm, length, loop_start, new_loop_start), new_loop_start)
+        sample.loop_point = 0 if new_loop_start == None else new_loop_start//16*9
+        self.ratios[label] = actual_ratio
+
+    def retune(self, ratios):
+        # the DSP plays a sample resampled by r at the same pitch if it goes r times as fast,
+        # the last 2 bytes of an instrument are its pitch multiplier in 8.8 fixed point
+        labels = dict(zip(self.sample_table.sample_ids, self.sample_table.sample_labels))
+        for instr in self.instr_table.instrs:
+            label = labels.get(self.sample_merges.get(instr[0], instr[0]))
+            r = ratios.get(label, 1.0)
+            if r == 1.0:
+                continue
+            tuning = round((instr[4] << 8 | instr[5])*r)
+            tuning = 1 if tuning < 1 else 0xFFFF if tuning > 0xFFFF else tuning
+            instr[4] = tuning >> 8
+            instr[5] = tuning & 0xFF
@@ -1,3 +0,0 @@
-
-class GlobalSettings:
-    game = 'common'
@@ -1,8 +1,11 @@
-from src.global_settings import GlobalSettings
 from src.spcfile import SPCFile
-import hashlib, os.path
+from src import brr
+import hashlib, io, os, os.path, struct, tempfile
 
 class BRRSample():
+    # header byte -> 1 if it ends the sample, for finding the end block with bytes.find
+    end_flags = bytes(b & 1 for b in range(0x100))
+
     def __init__(self, label=''):
         self.label = label
         self.data = bytearray()
@@ -10,58 +13,104 @@ class BRRSample():
         self.loop = False
 
     def extract_from_header(self, spc: SPCFile, addr):
-        saved_addr = spc.tell()
-        spc.seek(addr)
+        self.extract(spc, spc.u16(addr), spc.u16(addr+2))
 
-        p_start = spc.read_int(2)
-        p_loop = spc.read_int(2)
+    def extract(self, spc: SPCFile, p_start, p_loop):
         self.loop_point = p_loop-p_start
 
-        spc.seek(p_start)
-        while True:
-            header = spc.read_int(1)
-            self.data.append(header)
-            self.data.extend(spc.read(8))
-
-            if header & 1: # end of sample
-                self.loop = header & 2 == 2
-                break
-
-        spc.seek(saved_addr)
+        # the header of every block is every 9th byte, so look for the end flag in all of them at once
+        headers = bytes(spc.aram[p_start::9]).translate(BRRSample.end_flags)
+        i_end = headers.find(1)
+        if i_end == -1:
+            raise AssertionError(f'BRR sample at ${p_start:04X} has no end block')
+        p_end = p_start+(i_end+1)*9
+        if p_end > 0x10000:
+            raise AssertionError(f'BRR sample at ${p_start:04X} wraps past $FFFF')
+
+        self.data = bytearray(spc.slice(p_start, p_end-p_start))
+        self.loop = spc.u8(p_end-9) & 2 == 2
+
+    def decode(self, loops=0):
+        # signed 16-bit PCM, a looping sample has its loop played loops more times
+        return brr.decode(self.data, self.loop_point, self.loop, loops)
+
+    def audio_key(self):
+        # decoded audio and how it loops, trailing silence of a sample that doesn't loop doesn't matter
+        pcm = self.decode()
+        if self.loop:
+            return (True, self.loop_point//9*16, pcm)
+        n = len(pcm)
+        while n > 0 and pcm[n-1] == 0:
+            n -= 1
+        return (False, 0, pcm[:n])
 
 class SampleTable():
     def __init__(self, label=''):
         self.label = label
         self.sample_labels = []
+        self.sample_ids = []
         self.samples = {}
 
     def extract(self, spc: SPCFile, addr, count=0x100, used_sample_ids=None):
-        saved_addr = spc.tell()
-
+        # the DIR table is read in one go, entries past the end of ARAM don't exist
+        entries = list(struct.iter_unpack('<HH', spc.slice(addr, min(count*4, 0x10000-addr))))
         label_map = {}
-        for i in range(count):
-            spc.seek(addr+i*4)
-            p_start = spc.read_int(2)
-            p_end = spc.read_int(2)
-            if (p_start, p_end) in label_map:
-                label_map[(p_start, p_end)] += f'_{i:02X}'
+        for i, entry in enumerate(entries):
+            if entry in label_map:
+                label_map[entry] += f'_{i:02X}'
             else:
-                label_map[(p_start, p_end)] = f'Sample{i:02X}'
+                label_map[entry] = f'Sample{i:02X}'
 
-        for i in range(count):
+        for i, (p_start, p_loop) in enumerate(entries):
             if used_sample_ids == None or i in used_sample_ids:
-                spc.seek(addr+i*4)
-                p_start = spc.read_int(2)
-                p_end = spc.read_int(2)
-                if used_sample_ids == None and p_start == 0xFFFF and p_end == 0xFFFF:
+                if used_sample_ids == None and p_start == 0xFFFF and p_loop == 0xFFFF:
                     break
 
-                self.sample_labels.append(label_map[(p_start, p_end)])
-                sample = BRRSample(label_map[(p_start, p_end)])
-                sample.extract_from_header(spc, addr+i*4)
-                self.samples[label_map[(p_start, p_end)]] = sample
+                label = label_map[(p_start, p_loop)]
+                self.sample_labels.append(label)
+                self.sample_ids.append(i)
+                sample = BRRSample(label)
+                sample.extract(spc, p_start, p_loop)
+                self.samples[label] = sample
+
+    def dedup(self, tolerance=0):
+        # merges samples that decode to the same audio, or audio that differs by at most tolerance in every sample,
+        # into the smallest of them, removing the table entries and data of the others
+        # returns {merged sample id: sample id it was merged into} and the bytes of sample data removed
+        keys = {label: sample.audio_key() for label, sample in self.samples.items()}
+        canonical_labels = {} # label -> label it's merged into
+        kept = {} # (loop, loop start, length) -> labels
+        for label in sorted(self.samples, key=lambda label: len(self.samples[label].data)):
+            loop, loop_start, pcm = keys[label]
+            candidates = kept.setdefault((loop, loop_start, len(pcm)), [])
+            for candidate in candidates:
+                if keys[candidate][2] == pcm or (tolerance > 0 and max(abs(a-b) for a, b in zip(keys[candidate][2], pcm)) <= tolerance):
+                    canonical_labels[label] = candidate
+                    break
+            else:
+                candidates.append(label)
+                canonical_labels[label] = label
+
+        merges = {}
+        bytes_saved = 0
+        first_ids = {} # label -> first sample id using it
+        sample_labels = []
+        sample_ids = []
+        for i, label in zip(self.sample_ids, self.sample_labels):
+            canonical_label = canonical_labels[label]
+            if canonical_label in first_ids:
+                merges[i] = first_ids[canonical_label]
+            else:
+                first_ids[canonical_label] = i
+                sample_labels.append(canonical_label)
+                sample_ids.append(i)
+        for label, canonical_label in canonical_labels.items():
+            if label != canonical_label:
+                bytes_saved += len(self.samples.pop(label).data)
 
-        spc.seek(saved_addr)
+        self.sample_labels = sample_labels
+        self.sample_ids = sample_ids
+        return merges, bytes_saved
 
     def sample_table_to_asm(self):
         asm = ''
@@ -73,19 +122,55 @@ class SampleTable():
     def samples_to_asm(self, fp, hash_option=False):
         asm = ''
         for label, sample in self.samples.items():
-            if hash_option:
-                fn = f'Sample_{hashlib.md5(self.samples[label].data).hexdigest()}'
-            else:
-                fn = label
-            asm += f'  {label}: incbin "{os.path.join(fp, fn) + '.brr'}"\n'
+            asm += f'  {label}: incbin "{os.path.join(fp, self.sample_filename(label, hash_option)) + '.brr'}"\n'
         return asm
 
+    def sample_filename(self, label, hash_option=False):
+        # without extension
+        if hash_option:
+            return f'Sample_{hashlib.md5(self.samples[label].data).hexdigest()}'
+        return label
+
     def samples_to_files(self, fp, hash_option=False):
+        paths = []
+        for label, sample in self.samples.items():
+            path = os.path.join(fp, self.sample_filename(label, hash_option)) + '.brr'
+            paths.append(path)
+            if hash_option and os.path.exists(path):
+                continue
+
+            # hash named samples are shared between SPCs converted in parallel, so write to a temporary file and move it in place
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=fp)
+            with os.fdopen(fd, 'wb') as file:
+                file.write(sample.data)
+            os.replace(tmp_path, path)
+        return paths
+
+    def samples_to_wavs(self, fp, hash_option=False, loops=0, rate=32000):
+        # same names as samples_to_files
+        paths = []
+        for label, sample in self.samples.items():
+            path = os.path.join(fp, self.sample_filename(label, hash_option)) + '.wav'
+            paths.append(path)
+
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=fp)
+            with os.fdopen(fd, 'wb') as file:
+                brr.write_wav(file, sample.decode(loops), rate)
+            os.replace(tmp_path, path)
+        return paths
+
+    def sample_files(self, hash_option=False):
+        # (filename, data) of what samples_to_files writes, for writing somewhere else than a folder
+        return [(self.sample_filename(label, hash_option) + '.brr', bytes(sample.data)) for label, sample in self.samples.items()]
+
+    def wav_files(self, hash_option=False, loops=0, rate=32000):
+        # (filename, data) of what samples_to_wavs writes
+        files = []
         for label, sample in self.samples.items():
-            if hash_option:
-                label = f'Sample_{hashlib.md5(self.samples[label].data).hexdigest()}'
-            file = open(os.path.join(fp, label) + '.brr', 'wb')
-            file.write(sample.data)
+            file = io.BytesIO()
+            brr.write_wav(file, sample.decode(loops), rate)
+            files.append((self.sample_filename(label, hash_option) + '.wav', file.getvalue()))
+        return files
 
     def sample_map(used_samples, base=0x16):
         sample_map = {}
@@ -108,13 +193,10 @@ class InstrTable():
 
     def extract(self, spc: SPCFile, addr, used_instrs=None):
         used_sample_ids = set()
-        saved_addr = spc.tell()
         for i in sorted(used_instrs):
-            spc.seek(addr+i*6)
-            instr = [spc.read_int(1) for _ in range(6)]
+            instr = list(spc.slice(addr+i*6, 6))
             self.instrs.append(instr)
             used_sample_ids.add(instr[0])
-        spc.seek(saved_addr)
 
         return sorted(used_sample_ids)
 
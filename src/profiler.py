@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+import csv, json, time
+
+class Profiler():
+    # wall time per stage and counters for one conversion
+    # stages can be nested, the time of a nested stage isn't counted in the outer one, so the stages add up to the total
+    filename = 'nspc_profile'
+
+    def __init__(self, name='', enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.timings = {}
+        self.counters = {}
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(0.0) # time spent in nested stages
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter()-start
+            nested = self.stack.pop()
+            self.timings[name] = self.timings.get(name, 0.0)+elapsed-nested
+            if len(self.stack) > 0:
+                self.stack[-1] += elapsed
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0)+n
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def add(self, o):
+        for name, elapsed in o.timings.items():
+            self.timings[name] = self.timings.get(name, 0.0)+elapsed
+        for name, n in o.counters.items():
+            self.counters[name] = self.counters.get(name, 0)+n
+
+    def report(self):
+        lines = [f'{self.name}: {self.total()*1000:.2f} ms']
+        for name, elapsed in self.timings.items():
+            lines.append(f'  {name:12}{elapsed*1000:10.2f} ms')
+        for name, n in self.counters.items():
+            lines.append(f'  {name:12}{n:10}')
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {'name': self.name, 'total': self.total(), 'timings': self.timings, 'counters': self.counters}
+
+    def aggregate(profilers, name='total'):
+        total = Profiler(name)
+        for profiler in profilers:
+            total.add(profiler)
+        return total
+
+    def write_json(profilers, path):
+        # per file entries and their sum, times are in seconds
+        with open(path, 'w') as file:
+            json.dump({
+                'files': [profiler.to_dict() for profiler in profilers],
+                'total': Profiler.aggregate(profilers).to_dict()
+            }, file, indent=1)
+
+    def write_csv(profilers, path):
+        # one row per file and a last row with the sum, times are in milliseconds
+        total = Profiler.aggregate(profilers)
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['name', 'total'] + list(total.timings) + list(total.counters))
+            for profiler in profilers + [total]:
+                writer.writerow(
+                    [profiler.name, f'{profiler.total()*1000:.3f}'] +
+                    [f'{profiler.timings.get(name, 0.0)*1000:.3f}' for name in total.timings] +
+                    [profiler.counters.get(name, 0) for name in total.counters]
+                )
@@ -1,16 +1,126 @@
-from src.global_settings import GlobalSettings
 from src.spcfile import SPCFile
+from src.signature import SignatureScanner
+from src.track import Dialect, Tracker
 
 class NSPCScanner():
-    def __init__(self, spc: SPCFile):
+    # every signature is found in a single scan of ARAM, see the scan_* functions for what they are
+    signatures = SignatureScanner({
+        'instr_table': '8D 06 CF DA ?? 60 98 ?? ?? 98 ?? ??',
+        'tracker_pointers': '1C 5D F5 ?? ?? FD F5 ?? ?? DA ?? 8F 02 ??',
+        'tracker_pointers_hal': 'F0 0E 1C 5D F5 ?? ?? FD F5 ?? ?? DA ?? 8F 02 ??',
+        'tracker_pointers_yoshi': '1C 5D F5 ?? ?? FD D0 03 C4 ?? 6F F5 ?? ?? DA ?? 8F 02 ??',
+        'tracker_pointers_addmusic': '1C FD F6 ?? ?? 2D C4 40 F6 ?? ?? 2D C4 41',
+        'note_length_table': '2D 9F 28 07 FD F6 ?? ?? D5 ?? ?? AE 28 0F FD F6 ?? ?? D5 ?? ??'
+    })
+
+    def __init__(self, spc: SPCFile, dialect: Dialect=None):
         self.spc = spc
+        self.dialect = Dialect.get('common') if dialect == None else dialect
         self.instr_table_addr = None
         self.tracker_pointers_addr = None
         self.track_index = 0
         self.note_length_table_addr = None
+        self.matches = None
+
+    def scan_signatures(self):
+        if self.matches == None:
+            self.matches = NSPCScanner.signatures.scan(self.spc.image, 0x100, 0x10000)
+        return self.matches
+
+    def first_match(self, name):
+        matches = self.scan_signatures()[name]
+        if len(matches) == 0:
+            return None
+        return matches[0].bytes
+
+    def detect_game(self):
+        # picks the dialect of the SPC from the signatures found in the one scan of ARAM, and switches to it
+        # returns None if the SPC doesn't look like N-SPC at all
+        if self.first_match('tracker_pointers_addmusic') != None:
+            game = 'addmusic'
+        elif self.first_match('tracker_pointers_hal') != None:
+            # Kirby Super Star's beq $0E before the asl
+            game = 'hal'
+        elif self.first_match('tracker_pointers') != None or self.first_match('tracker_pointers_yoshi') != None:
+            # the rest of the games only differ in where they keep the track index, so try parsing the tracker each of them points to
+            game = None
+            best_score = -1
+            tracker = None
+            for candidate in ('common', 'f_zero', 'super_mario_all_stars'):
+                score, candidate_tracker = self.trial_parse(Dialect.get(candidate))
+                if score > best_score:
+                    game, best_score, tracker = candidate, score, candidate_tracker
+            if game == 'common' and tracker != None and self.has_dsp_echo_only(tracker):
+                # Thunder Spirits enables echo without any echo commands in the tracks
+                game = 'thunderspirits'
+        else:
+            return None
+
+        self.dialect = Dialect.get(game)
+        return game
+
+    def trial_parse(self, dialect: Dialect):
+        # scores how much of a valid tracker the track index of dialect points to, 0 if it doesn't parse
+        scanner = NSPCScanner(self.spc, dialect)
+        scanner.matches = self.matches
+        track_index = scanner.scan_track_index()
+        if track_index == 0:
+            return (0, None)
+        # a pointer past the end of ARAM fails the trial instead of reading the DSP registers or past the image
+        p_pointer = scanner.scan_tracker_pointers()+track_index*2-2
+        if p_pointer+2 > 0x10000:
+            return (0, None)
+        tracker = scanner.parse_tracker(self.spc.u16(p_pointer))
+        if tracker == None:
+            return (0, None)
+        return (1+tracker.track_count, tracker)
+
+    def parse_tracker(self, p_track):
+        # the tracker at p_track if it parses into at least one pattern of tracks in ARAM, else None
+        if p_track < 0x100:
+            return None
+        tracker = Tracker(dialect=self.dialect)
+        try:
+            tracker.extract(self.spc, p_track)
+        except (AssertionError, KeyError, IndexError, ValueError):
+            return None
+        if len(tracker.patterns) == 0:
+            return None
+        for pattern in tracker.patterns.values():
+            if any(track != None and track.addr < 0x100 for track in pattern.tracks):
+                return None
+        return tracker
+
+    def scan_songs(self):
+        # every song of the tracker pointer table as {track index: tracker address}
+        # invalid entries before the first song are skipped, the table ends at the first invalid entry after it
+        songs = {}
+        p_pointers = self.scan_tracker_pointers()
+        if p_pointers == None:
+            return songs
+        for i in range(1, 0x80):
+            if p_pointers+i*2 > 0x10000:
+                break
+            p_track = self.spc.u16(p_pointers+i*2-2)
+            if p_track == 0 or p_track in songs.values():
+                continue
+            if self.parse_tracker(p_track) != None:
+                songs[i] = p_track
+            elif len(songs) > 0:
+                break
+        return songs
+
+    def has_dsp_echo_only(self, tracker: Tracker):
+        if self.spc.u8(0x1004D) == 0 or (self.spc.u8(0x1002C) == 0 and self.spc.u8(0x1003C) == 0): # EON, EVOLL, EVOLR
+            return False
+        for track in tracker.tracks_and_subsections():
+            for command in track.commands:
+                if command[0] == 0xF5:
+                    return False
+        return True
 
     def scan_instr_table(self, p_track=0):
-        if GlobalSettings.game == 'addmusic':
+        if self.dialect.game == 'addmusic':
             # requires p_track
             self.spc.seek(p_track)
             while True:
@@ -23,59 +133,50 @@ class NSPCScanner():
             # scan for a 'mov y,#$06 : mul ya : movw pp,ya : clrc : adc pp,#$ll : adc pp+1,#$hh' where pp is usually $14 and hhll = instr_table_addr
             # there are a few cases where pp != $14
             # for example, KiKi KaiKai: Nazo no Kuro Mantle/Pocky and Rocky has 'adc $1C,#$00 : adc $1D,#$3E'
-            scanned_bytes = self.spc.scan('8D 06 CF DA ?? 60 98 ?? ?? 98 ?? ??')
+            scanned_bytes = self.first_match('instr_table')
             if scanned_bytes != None:
                 self.instr_table_addr = scanned_bytes[7]+scanned_bytes[10]*0x100
             return self.instr_table_addr
 
     def scan_tracker_pointers(self):
-        if GlobalSettings.game == 'addmusic':
+        if self.dialect.game == 'addmusic':
             # AddMusicKFF
-            scanned_bytes = self.spc.scan('1C FD F6 ?? ?? 2D C4 40 F6 ?? ?? 2D C4 41')
+            scanned_bytes = self.first_match('tracker_pointers_addmusic')
             if scanned_bytes != None:
                 self.tracker_pointers_addr = scanned_bytes[3]+scanned_bytes[4]*0x100+2
         else:
             # scan for a 'asl a : mov x,a : mov a,pppp-1+x : mov y,a : mov a,pppp-2+x : movw $40,ya : mov $0C,#$02' where pppp = tracker_pointers_addr (most games)
             # again, some games have $04, $40 and $0C repointed, and
             # Kirby Super Star has a beq $0E instead of a mov $04,a before the asl for some reason
-            scanned_bytes = self.spc.scan('1C 5D F5 ?? ?? FD F5 ?? ?? DA ?? 8F 02 ??')
+            scanned_bytes = self.first_match('tracker_pointers')
             if scanned_bytes != None:
                 self.tracker_pointers_addr = scanned_bytes[3]+scanned_bytes[4]*0x100+1
             else:
                 # Yoshi's Island
-                scanned_bytes = self.spc.scan('1C 5D F5 ?? ?? FD D0 03 C4 ?? 6F F5 ?? ?? DA ?? 8F 02 ??')
+                scanned_bytes = self.first_match('tracker_pointers_yoshi')
                 if scanned_bytes != None:
                     self.tracker_pointers_addr = scanned_bytes[3]+scanned_bytes[4]*0x100+1
         return self.tracker_pointers_addr
 
     def scan_track_index(self):
-        saved_addr = self.spc.tell()
-        match GlobalSettings.game:
+        match self.dialect.game:
             case 'f_zero':
-                self.spc.seek(0x04)
-                self.track_index = self.spc.read_int(1)
+                self.track_index = self.spc.u8(0x04)
             case 'super_mario_all_stars':
-                self.spc.seek(0xF6)
-                self.track_index = self.spc.read_int(1)
+                self.track_index = self.spc.u8(0xF6)
                 if self.track_index == 0:
-                    self.spc.seek(0x02)
-                    self.track_index = self.spc.read_int(1)
+                    self.track_index = self.spc.u8(0x02)
                 if self.track_index == 0:
-                    self.spc.seek(0x06)
-                    self.track_index = self.spc.read_int(1)
+                    self.track_index = self.spc.u8(0x06)
             case 'addmusic':
                 self.track_index = 0xA # for now it's hardcoded
             case _:
-                self.spc.seek(0xF4)
-                self.track_index = self.spc.read_int(1)
+                self.track_index = self.spc.u8(0xF4)
                 if self.track_index == 0:
-                    self.spc.seek(0x00)
-                    self.track_index = self.spc.read_int(1)
+                    self.track_index = self.spc.u8(0x00)
                 if self.track_index == 0:
-                    self.spc.seek(0x04)
-                    self.track_index = self.spc.read_int(1)
+                    self.track_index = self.spc.u8(0x04)
 
-        self.spc.seek(saved_addr)
         self.track_index &= 0x7F # needed for Tetris & Dr. Mario
         return self.track_index
 
@@ -91,7 +192,7 @@ class NSPCScanner():
         #$1850: FD        mov   y,a          ;|
         #$1851: F6 08 58  mov   a,$5808+y    ;} Track note volume multiplier * 100h = [$5808 + ([A] & Fh)]
         #$1854: D5 10 02  mov   $0210+x,a    ;/
-        scanned_bytes = self.spc.scan('2D 9F 28 07 FD F6 ?? ?? D5 ?? ?? AE 28 0F FD F6 ?? ?? D5 ?? ??')
+        scanned_bytes = self.first_match('note_length_table')
         if scanned_bytes != None:
             self.note_length_table_addr = scanned_bytes[6]+scanned_bytes[7]*0x100
         return self.note_length_table_addr
@@ -0,0 +1,53 @@
+import re
+
+class SignatureMatch():
+    def __init__(self, addr, scanned_bytes, mask):
+        self.addr = addr
+        self.bytes = scanned_bytes # every byte of the match, so indices line up with the signature
+        self.captures = [b for b, wildcard in zip(scanned_bytes, mask) if wildcard] # only the ?? bytes
+
+class SignatureScanner():
+    def __init__(self, signatures=None):
+        self.signatures = {}
+        self.anchors = {}
+        if signatures != None:
+            for name, signature in signatures.items():
+                self.add(name, signature)
+
+    def add(self, name, signature: str):
+        # a signature is a string like '8D 06 CF DA ?? 60' where ?? matches any byte
+        split = signature.split(' ')
+        mask = [b == '??' for b in split]
+        regex = re.compile(b''.join(b'.' if wildcard else re.escape(bytes([int(b, 16)])) for b, wildcard in zip(split, mask)), re.DOTALL)
+
+        # the longest run of fixed bytes is searched for with bytes.find, the regex only verifies candidates
+        anchor_start, anchor_len = 0, 0
+        start = 0
+        for i in range(len(split)+1):
+            if i == len(split) or mask[i]:
+                if i-start > anchor_len:
+                    anchor_start, anchor_len = start, i-start
+                start = i+1
+        if anchor_len == 0:
+            raise AssertionError(f'Signature {name} has no fixed bytes')
+        anchor = bytes(int(b, 16) for b in split[anchor_start:anchor_start+anchor_len])
+
+        self.signatures[name] = (regex, mask, anchor_start)
+        self.anchors.setdefault(anchor, []).append(name)
+
+    def scan(self, data, start=0, end=None):
+        # returns every match of every signature, in address order
+        if end == None:
+            end = len(data)
+        data = bytes(data) if type(data) != bytes else data
+        matches = {name: [] for name in self.signatures}
+        for anchor, names in self.anchors.items():
+            i = data.find(anchor, start, end)
+            while i != -1:
+                for name in names:
+                    regex, mask, anchor_start = self.signatures[name]
+                    addr = i-anchor_start
+                    if addr >= start and regex.match(data, addr, end) != None:
+                        matches[name].append(SignatureMatch(addr, list(data[addr:addr+len(mask)]), mask))
+                i = data.find(anchor, i+1, end)
+        return matches
@@ -1,36 +1,52 @@
+from src.signature import SignatureScanner
 
 class SPCFile():
-    def __init__(self, filename):
-        self.file = open(filename, 'rb')
+    # Addresses are ARAM addresses, the DSP registers follow at $10000
+    image_size = 0x10000+0x80
+
+    def __init__(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            data = bytes(source[0x100:0x100+self.image_size])
+        else:
+            with open(source, 'rb') as file:
+                file.seek(0x100)
+                data = file.read(self.image_size)
+        self.image = data.ljust(self.image_size, b'\0')
+        self.view = memoryview(self.image)
+        self.aram = self.view[:0x10000]
+        self.dsp = self.view[0x10000:]
+        self.pos = 0
 
     def read(self, n):
-        return self.file.read(n)
+        addr = self.pos
+        self.pos += n
+        return self.view[addr:addr+n]
 
     def read_int(self, n):
-        return int.from_bytes(self.read(n), 'little')
+        addr = self.pos
+        self.pos += n
+        if n == 1:
+            return self.image[addr] if addr < self.image_size else 0
+        return int.from_bytes(self.view[addr:addr+n], 'little')
 
     def seek(self, addr):
-        return self.file.seek(addr+0x100)
+        self.pos = addr
+        return addr
 
     def tell(self):
-        return self.file.tell()-0x100
+        return self.pos
+
+    def u8(self, addr):
+        return self.image[addr]
+
+    def u16(self, addr):
+        return self.image[addr] | self.image[addr+1] << 8
+
+    def slice(self, addr, n):
+        return self.view[addr:addr+n]
 
     def scan(self, bytes_to_scan: str):
-        saved_addr = self.tell()
-        split = bytes_to_scan.split(' ')
-        for addr in range(0x100, 0x10000-len(bytes_to_scan)+1):
-            self.seek(addr)
-            scanned_bytes = []
-            valid = True
-            for i in range(len(split)):
-                b = self.read_int(1)
-                scanned_bytes.append(b)
-                if split[i] != '??' and b != int(split[i], 16):
-                    valid = False
-                    break
-            if valid:
-                self.seek(saved_addr)
-                return scanned_bytes
-
-        self.seek(saved_addr)
-        return None
+        matches = SignatureScanner({'': bytes_to_scan}).scan(self.image, 0x100, 0x10000)['']
+        if len(matches) == 0:
+            return None
+        return matches[0].bytes
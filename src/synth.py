@@ -0,0 +1,253 @@
+from src.track import Track
+import random
+
+class SynthSPC():
+    # builds SPC files that look like N-SPC games to the scanner and parser, for benchmarks
+    sizes = {
+        # patterns, notes per track, distinct tracks per channel, songs
+        'small': (4, 24, 2, 2),
+        'medium': (16, 64, 6, 3),
+        'huge': (40, 96, 8, 3)
+    }
+
+    # ARAM layout
+    p_code = 0x0400
+    p_note_length_table = 0x0500
+    p_tracker_pointers = 0x0600
+    p_instr_table = 0x0700
+    p_sample_table = 0x0800
+    p_sequence_data = 0x1000
+    p_sample_data = 0xB000
+
+    def __init__(self, game='common', size='small', seed=0):
+        self.game = game
+        self.size = size
+        self.seed = seed
+        self.rng = random.Random(f'{game}/{size}/{seed}')
+        self.aram = bytearray(0x10000)
+        self.dsp = bytearray(0x80)
+        self.p_free = self.p_sequence_data
+
+        self.command_lengths = dict(Track.command_lengths)
+        if game in Track.custom_command_lengths:
+            self.command_lengths.update(Track.custom_command_lengths[game])
+        if game == 'addmusic':
+            # only commands that have an addmusic encoding, percussion and $FA don't
+            self.standard_to_game = {command: byte for byte, command in Track.map_addmusic_to_standard.items()}
+            self.opcodes = [command for command in self.command_lengths if command in self.standard_to_game or command >= 0x100]
+            self.instr_base = 0x1E
+        else:
+            self.standard_to_game = {}
+            self.opcodes = list(self.command_lengths)
+            self.instr_base = 0
+        self.opcodes = [command for command in self.opcodes if not command in (0xEF, 0x1E6)] # generated separately
+        self.n_instrs = 8
+
+    def put(self, addr, data):
+        self.aram[addr:addr+len(data)] = bytes(data)
+
+    def alloc(self, data):
+        addr = self.p_free
+        if addr+len(data) > self.p_sample_data:
+            raise AssertionError('Synthetic song does not fit in ARAM')
+        self.put(addr, data)
+        self.p_free += len(data)
+        return addr
+
+    def words(values):
+        data = []
+        for value in values:
+            data += [value & 0xFF, value >> 8]
+        return data
+
+    def encode(self, command):
+        # standard command -> bytes of the game
+        if command[0] >= 0x100:
+            return [command[0]-0x100] + command[1:]
+        return [self.standard_to_game.get(command[0], command[0])] + command[1:]
+
+    def random_command(self, command):
+        rng = self.rng
+        params = [rng.randrange(0x100) for _ in range(self.command_lengths[command])]
+        if command == 0xE0:
+            params[0] = self.instr_base+rng.randrange(self.n_instrs)
+        elif command == 0xF7:
+            params = [rng.randrange(0x10), rng.randrange(0x100), rng.randrange(4)]
+        elif command == 0xF9:
+            params[2] = 0x80+rng.randrange(0x46)
+        elif command == 0xFA:
+            params[0] = 0
+        elif command in (0xED, 0xEE):
+            params[-1] &= 0x7F # leave room for --amplify
+        return self.encode([command] + params)
+
+    def note(self):
+        rng = self.rng
+        r = rng.random()
+        if r < 0.7:
+            return 0x80+rng.randrange(0x46)
+        elif r < 0.8:
+            return self.encode([0xC8])[0] # tie
+        elif r < 0.9 or self.game == 'addmusic':
+            return self.encode([0xC9])[0] # rest
+        return 0xCA+rng.randrange(6) # percussion
+
+    def track(self, units, subsections, every_command=False, note_len=True):
+        # a track playing units notes of the same length, so every track of a pattern ends together
+        # without note_len, the notes play with the note length the track is called with
+        rng = self.rng
+        data = []
+        if self.game != 'addmusic':
+            data += [0xFA, 0]
+        if every_command:
+            for command in self.opcodes:
+                data += self.random_command(command)
+        if note_len:
+            data += [0x18, rng.randrange(0x80)]
+        while units > 0:
+            r = rng.random()
+            if r < 0.25:
+                data += self.random_command(rng.choice(self.opcodes))
+            elif r < 0.3 and len(subsections) > 0:
+                p_subsection, subsection_units, has_note_len = rng.choice(subsections)
+                repetitions = rng.randrange(1, 3)
+                # the same subsection is also called with half the note length
+                half = not has_note_len and subsection_units % 2 == 0 and rng.random() < 0.5
+                if half:
+                    subsection_units //= 2
+                if subsection_units*repetitions <= units:
+                    if half:
+                        data += [0x0C, rng.randrange(0x80)]
+                    data += self.encode([0xEF]) + SynthSPC.words([p_subsection]) + [repetitions]
+                    data += [0x18, rng.randrange(0x80)]
+                    units -= subsection_units*repetitions
+            elif r < 0.33 and self.game == 'addmusic' and len(subsections) > 0 and units >= 4:
+                # subloop of 2 notes
+                repetitions = rng.randrange(1, 3)
+                if 2*(repetitions+1) <= units:
+                    data += [0xE6, 0, self.note(), self.note(), 0xE6, repetitions]
+                    units -= 2*(repetitions+1)
+            else:
+                data.append(self.note())
+                units -= 1
+        data.append(0)
+        return data
+
+    def song(self, n_patterns, n_notes, n_distinct, first):
+        rng = self.rng
+        subsections = []
+        for i in range(4):
+            units = rng.randrange(2, 6)
+            subsections.append((self.alloc(self.track(units, [], note_len=i < 3)), units, i < 3))
+
+        # every channel picks from a few tracks, some of them copied to another address
+        pool = [[None]*n_distinct for _ in range(8)]
+        patterns = []
+        for i in range(n_patterns):
+            n_channels = rng.randrange(2, 9)
+            p_tracks = [0]*8
+            for channel in range(n_channels):
+                k = rng.randrange(n_distinct)
+                if pool[channel][k] == None or rng.random() < 0.1:
+                    if pool[channel][k] != None and rng.random() < 0.5:
+                        p_track, size = pool[channel][k]
+                        data = self.aram[p_track:p_track+size]
+                    else:
+                        data = self.track(n_notes, subsections, every_command=first and i == 0 and channel == 0)
+                    pool[channel][k] = (self.alloc(data), len(data))
+                p_tracks[channel] = pool[channel][k][0]
+            patterns.append(self.alloc(SynthSPC.words(p_tracks)))
+
+        commands = []
+        for p_pattern in patterns:
+            commands.append(p_pattern)
+            if rng.random() < 0.3:
+                commands.append(p_pattern)
+        p_tracker = self.p_free
+        self.alloc(SynthSPC.words(commands + [0x00FF, p_tracker+2])) # loop back to the second pattern
+        if self.game == 'addmusic':
+            # the instrument table is found from the end of the tracker, custom instruments start at $1E
+            self.alloc(self.instrs())
+        return p_tracker
+
+    def instrs(self):
+        data = []
+        for i in range(self.n_instrs):
+            data += [i, 0xFF, 0xE0, 0xB8, self.rng.randrange(1, 8), self.rng.randrange(0x100)]
+        return data
+
+    def samples(self):
+        rng = self.rng
+        self.put(self.p_sample_table, [0xFF]*0x400)
+        addr = self.p_sample_data
+        for i in range(self.n_instrs):
+            n_blocks = rng.randrange(2, 40)
+            data = []
+            for block in range(n_blocks):
+                header = rng.randrange(13) << 4 | rng.randrange(4) << 2
+                if block == n_blocks-1:
+                    header |= 1 | (i & 1) << 1 # end, loop every other sample
+                data += [header] + [rng.randrange(0x100) for _ in range(8)]
+            p_loop = addr+9*rng.randrange(n_blocks)
+            self.put(self.p_sample_table+i*4, SynthSPC.words([addr, p_loop]))
+            self.put(addr, data)
+            addr += len(data)
+
+    def code(self):
+        if self.game == 'addmusic':
+            self.put(self.p_code, [0x1C, 0xFD, 0xF6] + SynthSPC.words([self.p_tracker_pointers-2]) + [0x2D, 0xC4, 0x40, 0xF6] + SynthSPC.words([self.p_tracker_pointers-1]) + [0x2D, 0xC4, 0x41])
+            return
+
+        self.put(self.p_code, [0x8D, 0x06, 0xCF, 0xDA, 0x14, 0x60, 0x98, self.p_instr_table & 0xFF, 0x14, 0x98, self.p_instr_table >> 8, 0x15])
+        # Kirby Super Star has a beq $0E before the asl
+        prefix = [0xF0, 0x0E] if self.game == 'hal' else [0xC4, 0x04]
+        if self.seed % 2 == 0:
+            tracker_code = [0x1C, 0x5D, 0xF5] + SynthSPC.words([self.p_tracker_pointers-1]) + [0xFD, 0xF5] + SynthSPC.words([self.p_tracker_pointers-2]) + [0xDA, 0x40, 0x8F, 0x02, 0x0C]
+        else:
+            # Yoshi's Island
+            tracker_code = [0x1C, 0x5D, 0xF5] + SynthSPC.words([self.p_tracker_pointers-1]) + [0xFD, 0xD0, 0x03, 0xC4, 0x04, 0x6F, 0xF5] + SynthSPC.words([self.p_tracker_pointers-2]) + [0xDA, 0x40, 0x8F, 0x02, 0x0C]
+        self.put(self.p_code+0x20, prefix + tracker_code)
+        self.put(self.p_code+0x40, [0x2D, 0x9F, 0x28, 0x07, 0xFD, 0xF6] + SynthSPC.words([self.p_note_length_table]) + [0xD5, 0x01, 0x02, 0xAE, 0x28, 0x0F, 0xFD, 0xF6] + SynthSPC.words([self.p_note_length_table+8]) + [0xD5, 0x10, 0x02])
+
+        note_length_table = Track.standard_note_length_table[:]
+        if self.seed % 3 == 1:
+            note_length_table[0] = 0x30
+        self.put(self.p_note_length_table, note_length_table)
+
+    def build(self):
+        n_patterns, n_notes, n_distinct, n_songs = self.sizes[self.size]
+
+        self.code()
+        i_first_song = 0xA if self.game == 'addmusic' else 1
+        for song in range(n_songs):
+            p_tracker = self.song(n_patterns if song == 0 else max(2, n_patterns//4), n_notes, n_distinct, song == 0)
+            self.put(self.p_tracker_pointers+(i_first_song+song)*2-2, SynthSPC.words([p_tracker]))
+        if self.game != 'addmusic':
+            self.put(self.p_instr_table, self.instrs())
+        self.samples()
+
+        # the track index is where the game keeps it
+        match self.game:
+            case 'f_zero':
+                self.aram[0x04] = i_first_song
+            case 'super_mario_all_stars':
+                self.aram[0xF6] = i_first_song
+            case 'addmusic':
+                pass
+            case _:
+                self.aram[0xF4] = i_first_song
+
+        self.dsp[0x0C] = 0x50 # MVOLL
+        self.dsp[0x1C] = 0x50 # MVOLR
+        self.dsp[0x2C] = 0x20 # EVOLL
+        self.dsp[0x3C] = 0xE0 # EVOLR
+        self.dsp[0x4D] = 0x0F # EON
+        self.dsp[0x5D] = self.p_sample_table >> 8 # DIR
+        self.dsp[0x7D] = 0x04 # EDL
+        self.dsp[0x0D] = 0x40 # EFB
+        self.dsp[0x0F] = 0x58 # FIR0
+
+        header = bytearray(0x100)
+        header[:0x21] = b'SNES-SPC700 Sound File Data v0.30'
+        header[0x21:0x25] = b'\x1A\x1A\x1A\x1E'
+        return bytes(header) + bytes(self.aram) + bytes(self.dsp) + bytes(0x80)
@@ -1,6 +1,91 @@
-from src.global_settings import GlobalSettings
 from src.spcfile import SPCFile
-import copy
+from src.profiler import Profiler
+from array import array
+
+class ParseCache():
+    # decoded tracks and subsections of one SPC, keyed by (address, len_limit, initial note length, game),
+    # subsections by (address, None, None, game)
+    # trackers sharing a cache number their patterns together, so the labels of shared tracks stay unique
+    def __init__(self):
+        self.tracks = {}
+        self.subsections = {}
+        self.hits = 0
+        self.pattern_count = 0
+
+    def key(addr, len_limit, note_len, dialect):
+        return (addr, len_limit, note_len, dialect.game)
+
+    def get(self, key):
+        track = self.tracks.get(key)
+        if track != None:
+            self.hits += 1
+        return track
+
+    def add(self, key, track):
+        self.tracks[key] = track
+        if track.is_subroutine:
+            self.subsections[track.label] = track
+
+class CommandList():
+    # commands packed as opcode, params... into one array, with the start of each command in offsets
+    # a subsection command stores an index into subsections instead of the Track
+    __slots__ = ('data', 'offsets', 'subsections')
+
+    def __init__(self, commands=()):
+        self.data = array('h')
+        self.offsets = array('I')
+        self.subsections = []
+        for command in commands:
+            self.append(command)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.offsets)
+        start = self.offsets[i]
+        end = self.offsets[i+1] if i+1 < len(self.offsets) else len(self.data)
+        if self.data[start] == 0xEF:
+            return (0xEF, self.subsections[self.data[start+1]], self.data[start+2])
+        return tuple(self.data[start:end])
+
+    def __iter__(self):
+        data = self.data
+        ends = self.offsets[1:]
+        ends.append(len(data))
+        for start, end in zip(self.offsets, ends):
+            if data[start] == 0xEF:
+                yield (0xEF, self.subsections[data[start+1]], data[start+2])
+            else:
+                yield tuple(data[start:end])
+
+    def __eq__(self, o):
+        if type(self) != type(o):
+            return False
+        return self.data == o.data and self.offsets == o.offsets and self.subsections == o.subsections
+
+    def __hash__(self):
+        return hash((self.data.tobytes(), self.offsets.tobytes()))
+
+    def append(self, command):
+        self.offsets.append(len(self.data))
+        if command[0] == 0xEF:
+            self.data.extend((0xEF, len(self.subsections), command[2]))
+            self.subsections.append(command[1])
+        else:
+            self.data.extend(command)
+
+    def set_param(self, i, j, value):
+        # in place edit of parameter j (1 = first parameter) of command i
+        self.data[self.offsets[i]+j] = value
+
+    def byte_size(self):
+        # a subsection call is stored as 3 values but takes 4 bytes
+        return len(self.data)+len(self.subsections)
+
+    def fingerprint(self):
+        return (self.data.tobytes(), self.offsets.tobytes(), tuple(subsection.fingerprint() for subsection in self.subsections))
 
 class Track():
     keys = ['!c', '!cs', '!d', '!ds', '!e', '!f', '!fs', '!g', '!gs', '!a', '!as', '!b']
@@ -159,30 +244,41 @@ class Track():
     def __init__(self, label=''):
         self.addr = 0
         self.label = label
-        self.commands = []
+        self.commands = CommandList()
         self.len = 0
         self.len_before_subloops = 0
-        self.index_before_subloop = 0
         self.note_len = 0
+        self.size = 0
         self.is_subroutine = False
+        self.dialect = None
+        self.play_lens = {} # note length -> play_len
 
     def __eq__(self, o):
         if type(self) != type(o):
             return False
         return self.commands == o.commands
 
-    def extract(self, spc: SPCFile, addr, len_limit=None, unroll_subloops=True):
+    def fingerprint(self):
+        # hashable form of the command stream, subsections are replaced by their own fingerprint
+        return self.commands.fingerprint()
+
+    def byte_size(self):
+        # size of the commands and the terminator in the engine
+        return self.commands.byte_size()+1
+
+    def extract(self, spc: SPCFile, addr, len_limit=None, cache: ParseCache=None, dialect=None):
+        # addmusic subloops are kept as their start and end commands, see lower_subloops
+        if dialect == None:
+            dialect = Dialect.get('common')
         saved_addr = spc.tell()
         spc.seek(addr)
         self.addr = addr
+        self.dialect = dialect
+        byte_map = dialect.byte_map
+        command_lengths = dialect.command_lengths
 
         while True:
-            command = spc.read_int(1)
-            if GlobalSettings.game == 'addmusic':
-                if command in self.map_addmusic_to_standard:
-                    command = self.map_addmusic_to_standard[command]
-                elif command >= 0xDA:
-                    command += 0x100
+            command = byte_map[spc.read_int(1)]
             if command == 0: # terminator
                 break
             elif command < 0x80: # note length
@@ -211,69 +307,140 @@ class Track():
                 subsection_addr = spc.read_int(2)
                 repetitions = spc.read_int(1)
 
-                subsection = Track(label=f'.sub{subsection_addr:04X}')
-                subsection.is_subroutine = True
-                subsection.note_len = self.note_len
-                subsection.extract(spc, subsection_addr)
+                # the commands of a subsection don't depend on the note length it's called with, only its length does,
+                # so there's one subsection per address and label
+                key = ParseCache.key(subsection_addr, None, None, dialect)
+                subsection = None if cache == None else cache.get(key)
+                if subsection == None:
+                    subsection = Track(label=f'.sub{subsection_addr:04X}')
+                    subsection.is_subroutine = True
+                    subsection.extract(spc, subsection_addr, cache=cache, dialect=dialect)
+                    if cache != None:
+                        cache.add(key, subsection)
 
                 if repetitions > 0:
-                    self.note_len = subsection.note_len
-                    self.len += subsection.len*repetitions
+                    length, self.note_len = subsection.play_len(self.note_len)
+                    self.len += length*repetitions
                 self.commands.append([command, subsection, repetitions])
                 if len_limit != None and self.len >= len_limit:
                     break
             else: # track command
-                if GlobalSettings.game in Track.custom_command_lengths and command in Track.custom_command_lengths[GlobalSettings.game]:
-                    length = Track.custom_command_lengths[GlobalSettings.game][command]
-                else:
-                    length = Track.command_lengths[command]
-                params = [spc.read_int(1) for _ in range(length)]
-                if GlobalSettings.game == 'hal':
+                params = [spc.read_int(1) for _ in range(command_lengths[command])]
+                if dialect.reversed_panning:
                     # Panning is reversed in HAL games
                     if command == 0xE1:
                         params[0] = (20 - (params[0] & 0x1F)) | (params[0] & 0xE0)
                     elif command == 0xE2:
                         params[1] = (20 - (params[1] & 0x1F)) | (params[1] & 0xE0)
-                if GlobalSettings.game == 'addmusic':
-                    if command == 0x1E6: # subloop
-                        if params[0] == 0:
-                            self.len_before_subloops = self.len
-                            self.index_before_subloop = len(self.commands)
-                            if unroll_subloops:
-                                continue
-                        else:
-                            self.len += (self.len-self.len_before_subloops)*params[0]
-                            if unroll_subloops:
-                                self.commands += self.commands[self.index_before_subloop:]*params[0]
-                                continue
+                if dialect.subloops and command == 0x1E6: # subloop start (0) or end (number of repeats)
+                    if params[0] == 0:
+                        self.len_before_subloops = self.len
+                    else:
+                        self.len += (self.len-self.len_before_subloops)*params[0]
                 self.commands.append([command] + params)
 
+        self.size = spc.tell()-addr
         spc.seek(saved_addr)
 
+    def play_len(self, note_len):
+        # (length, note length after) of playing the commands once starting with note_len, like extract counts them
+        lengths = self.play_lens.get(note_len)
+        if lengths == None:
+            length = 0
+            len_before_subloops = 0
+            end_note_len = note_len
+            for command in self.commands:
+                if command[0] < 0x80:
+                    end_note_len = command[0]
+                elif command[0] < 0xE0:
+                    length += end_note_len
+                elif command[0] == 0x1E6 and self.dialect.subloops:
+                    if command[1] == 0:
+                        len_before_subloops = length
+                    else:
+                        length += (length-len_before_subloops)*command[1]
+            lengths = self.play_lens[note_len] = (length, end_note_len)
+        return lengths
+
+    def has_subloops(self):
+        return 0x1E6 in self.commands.data
+
+    def lower_subloops(self, bodies=None, subsections=None):
+        # replaces addmusic subloops by commands the engine has
+        # with bodies ({fingerprint: subsection}, shared by the tracks of a tracker) and subsections (label -> Track),
+        # a loop is played by calling a subsection with the loop body when that's smaller, otherwise the body is unrolled
+        if not self.has_subloops():
+            return
+        # like the engine, an end without a start loops from the beginning of the track, and an end after another one
+        # loops from the last start again, through the repeats of the earlier loop
+        commands = []
+        start = 0
+        old_commands = list(self.commands)
+        for i, command in enumerate(old_commands):
+            if command[0] != 0x1E6:
+                commands.append(command)
+            elif command[1] == 0:
+                start = len(commands)
+            else:
+                body = commands[start:]
+                body_commands = CommandList(body)
+                subsection = None
+                next_command = next((later for later in old_commands[i+1:] if later[0] != 0x1E6), None)
+                if bodies != None and Track.can_be_subsection(body, next_command) and command[1] < 0xFF and not self.is_subroutine:
+                    subsection = bodies.get(body_commands.fingerprint())
+                    # a call takes 4 bytes, and a new subsection its body and terminator
+                    call_size = 4 if subsection != None else 4+body_commands.byte_size()+1
+                    if call_size >= body_commands.byte_size()*(command[1]+1):
+                        subsection = None
+                    elif subsection == None:
+                        subsection = Track(label=f'.subloop{len(bodies)}')
+                        subsection.is_subroutine = True
+                        subsection.dialect = self.dialect
+                        subsection.commands = body_commands
+                        bodies[body_commands.fingerprint()] = subsection
+                        subsections[subsection.label] = subsection
+                if subsection != None:
+                    commands[start:] = [(0xEF, subsection, command[1]+1)]
+                else:
+                    commands += body*command[1]
+        self.commands = CommandList(commands)
+
+    def can_be_subsection(commands, next_command=None):
+        # subsections can't be nested, and a note length without a volume byte at the end would read the terminator as its volume
+        # the engine only reads a pitch slide right after a note, so commands can't start with one,
+        # or end on a note or slide that next_command, the command played after them, is a pitch slide for
+        if len(commands) == 0 or any(command[0] == 0xEF for command in commands):
+            return False
+        if commands[-1][0] < 0x80 and len(commands[-1]) == 1:
+            return False
+        if commands[0][0] == 0xF9:
+            return False
+        return not (next_command != None and next_command[0] == 0xF9 and (0x80 <= commands[-1][0] < 0xE0 or commands[-1][0] == 0xF9))
+
     def amplify(self, vol_multiplier):
         if vol_multiplier > 1:
-            for command in self.commands:
+            for i, command in enumerate(self.commands):
                 if command[0] == 0xED:
                     if round(command[1] * vol_multiplier) > 255:
                         raise AssertionError('Track volume is over 255')
-                    command[1] = round(command[1] * vol_multiplier)
+                    self.commands.set_param(i, 1, round(command[1] * vol_multiplier))
                 elif command[0] == 0xEE:
                     if round(command[2] * vol_multiplier) > 255:
                         raise AssertionError('Track volume is over 255')
-                    command[2] = round(command[2] * vol_multiplier)
+                    self.commands.set_param(i, 2, round(command[2] * vol_multiplier))
         elif vol_multiplier < 1:
-            for command in self.commands:
+            for i, command in enumerate(self.commands):
                 if command[0] == 0xE5:
-                    command[1] = round(command[1] * vol_multiplier)
+                    self.commands.set_param(i, 1, round(command[1] * vol_multiplier))
                 elif command[0] == 0xE6:
-                    command[2] = round(command[2] * vol_multiplier)
+                    self.commands.set_param(i, 2, round(command[2] * vol_multiplier))
 
     def normalize_echo_volume(self, main_vol_l=0x60, main_vol_r=0x60, target_main_vol_l=0x60, target_main_vol_r=0x60):
         signed = lambda n: n-0x100 if n >= 0x80 else n
-        for command in self.commands:
+        for i, command in enumerate(self.commands):
             if command[0] == 0xF5 or command[0] == 0xF8:
-                command[2] = round(signed(command[2])*target_main_vol_l/main_vol_l)
-                command[3] = round(signed(command[3])*target_main_vol_r/main_vol_l)
+                self.commands.set_param(i, 2, round(signed(command[2])*target_main_vol_l/main_vol_l))
+                self.commands.set_param(i, 3, round(signed(command[3])*target_main_vol_r/main_vol_l))
 
     def asm_defines():
         defines = ''
@@ -288,101 +455,151 @@ class Track():
         defines += '\n'
         return defines
 
-    def to_asm(self, end=True, perc_base=0, first_perc=None, use_custom_note_length_table=False, prefix='', spc: SPCFile=None):
+    def to_asm(self, end=True, perc_base=0, first_perc=None, use_custom_note_length_table=False, prefix='', spc: SPCFile=None, first=False):
+        return ''.join(self.asm_lines(end, perc_base, first_perc, use_custom_note_length_table, prefix, spc, first))
+
+    def asm_lines(self, end=True, perc_base=0, first_perc=None, use_custom_note_length_table=False, prefix='', spc: SPCFile=None, first=False):
+        # the commands are formatted as one chunk, everything else line by line
+        # the first track of a song sets up what the song needs before its commands
         signed = lambda n: n-0x100 if n >= 0x80 else n
 
-        asm = f'{self.label}\n'
-        #asm = f'{self.label} ; ${self.addr:04X}\n'
-        if self.label == '.pattern0_0':
+        yield f'{self.label}\n'
+        #yield f'{self.label} ; ${self.addr:04X}\n'
+        if first:
             if prefix != '':
-                asm += f'  {prefix}\n'
-            if GlobalSettings.game == 'thunderspirits':
+                yield f'  {prefix}\n'
+            if self.dialect.game == 'thunderspirits':
                 # read dsp registers for echo bc echo commands aren't there lol, haven't figured out what sets the echo
-                saved_addr = spc.tell()
 
                 # main volume = 0x60, so no echo volume normalization is made
-                spc.seek(0x1004D) # EON
-                eon = spc.read_int(1)
-                spc.seek(0x1002C) # EVOLL
-                evol_l = spc.read_int(1)
-                spc.seek(0x1003C) # EVOLR
-                evol_r = spc.read_int(1)
+                eon = spc.u8(0x1004D) # EON
+                evol_l = spc.u8(0x1002C) # EVOLL
+                evol_r = spc.u8(0x1003C) # EVOLR
 
                 if evol_l == 0 and evol_r == 0:
-                    asm += '  !endEcho\n'
+                    yield '  !endEcho\n'
                 else:
-                    asm += f'  !echo,%{eon:08b},{signed(evol_l)},{signed(evol_r)}\n'
+                    yield f'  !echo,%{eon:08b},{signed(evol_l)},{signed(evol_r)}\n'
 
-                    spc.seek(0x1007D) # EDL
-                    edl = spc.read_int(1)
-                    spc.seek(0x1000D) # EFB
-                    efb = spc.read_int(1)
+                    edl = spc.u8(0x1007D) # EDL
+                    efb = spc.u8(0x1000D) # EFB
                     # choose fir filter index based on first byte of fir filter
-                    spc.seek(0x1000F) # FIR0
-                    i_fir = [0x7F, 0x58, 0x0C, 0x34].index(spc.read_int(1))
+                    i_fir = [0x7F, 0x58, 0x0C, 0x34].index(spc.u8(0x1000F)) # FIR0
 
-                    asm += f'  !echoParameters,{edl},{signed(efb)},{i_fir}\n'
-                
-                spc.seek(saved_addr)
+                    yield f'  !echoParameters,{edl},{signed(efb)},{i_fir}\n'
             if use_custom_note_length_table:
-                asm += '  !setNoteLengthTable : dw NoteLengthTable\n'
+                yield '  !setNoteLengthTable : dw NoteLengthTable\n'
 
-        for command in self.commands:
-            asm += '  '
-            if command[0] < 0x80:
-                asm += f'db {command[0]}{''.join(f',${b:02X}' for b in command[1:])}\n'
-            elif command[0] < 0xC8:
-                asm += f'{Track.keys[(command[0]-0x80)%12]}{(command[0]-0x80)//12+2}\n'
-            elif command[0] == 0xC8:
-                asm += '!tie\n'
-            elif command[0] == 0xC9:
-                asm += '!rest\n'
-            elif command[0] < 0xE0:
-                #asm += f'%percNote(${command[0]-0xCA:02X})\n'
-                asm += f'%percNote(!instr{command[0]-0XCA+perc_base:02X}-!instr{first_perc:02X})\n'
-            elif command[0] == 0xEF:
-                asm += f'{Track.command_names[0xEF]} : dw {command[1].label} : db {command[2]}\n'
+        yield self.dialect.formatter.format(self.commands, perc_base, first_perc)
+        if end:
+            yield '  !end\n'
+
+class TrackFormatter():
+    # tables of ASM lines indexed by command, built once per game by its Dialect
+    def __init__(self, game):
+        self.game = game
+        self.note_names = [f'{Track.keys[note%12]}{note//12+2}' for note in range(0x80)]
+        self.constants = [None]*0x200 # lines of commands that don't depend on parameters
+        self.table = [None]*0x200 # formatters taking (command, perc_base, first_perc) for everything else
+
+        hex_bytes = [f'${b:02X}' for b in range(0x100)]
+        for command in range(1, 0x80):
+            self.table[command] = lambda command, perc_base, first_perc: f'  db {command[0]}{''.join([f',{hex_bytes[b]}' for b in command[1:]])}\n'
+        for command in range(0x80, 0xC8):
+            self.constants[command] = f'  {self.note_names[command-0x80]}\n'
+        self.constants[0xC8] = '  !tie\n'
+        self.constants[0xC9] = '  !rest\n'
+        for command in range(0xCA, 0xE0):
+            self.table[command] = lambda command, perc_base, first_perc: f'  %percNote(!instr{command[0]-0xCA+perc_base:02X}-!instr{first_perc:02X})\n'
+
+        names = dict(Track.command_names)
+        lengths = dict(Track.command_lengths)
+        if game in Track.custom_command_names:
+            names.update(Track.custom_command_names[game])
+            lengths.update(Track.custom_command_lengths[game])
+        for command, name in names.items():
+            if lengths[command] == 0:
+                self.constants[command] = f'  {name}\n'
             else:
-                params = [f',{b}' for b in command[1:]]
-                if command[0] == 0xE0:
-                    #params[0] = f',${command[1]:02X}'
-                    if command[1] >= 0xCA: # select percussion instrument
-                        params[0] = f',!instr{command[1]-0xCA+perc_base:02X}'
-                    else:
-                        params[0] = f',!instr{command[1]:02X}'
-                elif command[0] == 0xF5:
-                    params[0] = f',%{command[1]:08b}'
-                elif command[0] == 0xF9:
-                    params[2] = f' : {Track.keys[(command[3]&0x7F)%12]}{(command[3]&0x7F)//12+2}'
-                elif command[0] == 0xFA:
-                    #params[0] = f',${command[1]:02X}'
-                    if first_perc == None:
-                        asm = asm[:-2]
-                        continue
-                    params[0] = f',!instr{first_perc:02X}'
-                if GlobalSettings.game in Track.custom_command_names and command[0] in Track.custom_command_names[GlobalSettings.game]:
-                    if GlobalSettings.game == 'addmusic':
-                        if command[0] == 0x1F4:
-                            if command[1] in self.addmusicF4_command_names:
-                                asm += f'{self.addmusicF4_command_names[command[1]]}\n'
-                                continue
-                        if command[0] == 0x1FA:
-                            if command[1] in self.addmusicFA_command_names:
-                                asm += f'{self.addmusicFA_command_names[command[1]]},{command[2]}\n'
-                                continue
-                    asm += f'{Track.custom_command_names[GlobalSettings.game][command[0]]}{''.join(params)}\n'
+                self.table[command] = lambda command, perc_base, first_perc, name=name: f'  {name},{','.join(map(str, command[1:]))}\n'
+
+        self.table[0xE0] = self.instr
+        self.table[0xEF] = lambda command, perc_base, first_perc: f'  {Track.command_names[0xEF]} : dw {command[1].label} : db {command[2]}\n'
+        self.table[0xF5] = lambda command, perc_base, first_perc: f'  {Track.command_names[0xF5]},%{command[1]:08b},{command[2]},{command[3]}\n'
+        self.table[0xF9] = lambda command, perc_base, first_perc: f'  {Track.command_names[0xF9]},{command[1]},{command[2]} : {self.note_names[command[3]&0x7F]}\n'
+        self.table[0xFA] = lambda command, perc_base, first_perc: '' if first_perc == None else f'  {Track.command_names[0xFA]},!instr{first_perc:02X}\n'
+        if game == 'addmusic':
+            generic_F4 = self.table[0x1F4]
+            generic_FA = self.table[0x1FA]
+            self.table[0x1F4] = lambda command, perc_base, first_perc: f'  {Track.addmusicF4_command_names[command[1]]}\n' if command[1] in Track.addmusicF4_command_names else generic_F4(command, perc_base, first_perc)
+            self.table[0x1FA] = lambda command, perc_base, first_perc: f'  {Track.addmusicFA_command_names[command[1]]},{command[2]}\n' if command[1] in Track.addmusicFA_command_names else generic_FA(command, perc_base, first_perc)
+
+    def instr(self, command, perc_base, first_perc):
+        if command[1] >= 0xCA: # select percussion instrument
+            return f'  {Track.command_names[0xE0]},!instr{command[1]-0xCA+perc_base:02X}\n'
+        return f'  {Track.command_names[0xE0]},!instr{command[1]:02X}\n'
+
+    def format(self, commands: CommandList, perc_base=0, first_perc=None):
+        table = self.table
+        constants = self.constants
+        data = commands.data
+        ends = commands.offsets[1:]
+        ends.append(len(data))
+        lines = []
+        for start, end in zip(commands.offsets, ends):
+            line = constants[data[start]]
+            if line == None:
+                if data[start] == 0xEF:
+                    command = (0xEF, commands.subsections[data[start+1]], data[start+2])
                 else:
-                    asm += f'{Track.command_names[command[0]]}{''.join(params)}\n'
-        if end:
-            asm += '  !end\n'
-        return asm
+                    command = tuple(data[start:end])
+                line = table[data[start]](command, perc_base, first_perc)
+            lines.append(line)
+        return ''.join(lines)
+
+class Dialect():
+    # everything that differs between the N-SPC variants of the supported games, resolved once per game
+    # and passed to the scanner, parser and emitter, so SPCs of different games can be converted at the same time
+    dialects = {}
+
+    def get(game):
+        dialect = Dialect.dialects.get(game)
+        if dialect == None:
+            dialect = Dialect.dialects.setdefault(game, Dialect(game))
+        return dialect
+
+    def __init__(self, game):
+        self.game = game
+
+        # byte in the track data -> standard command, custom commands are $100 + the byte
+        self.byte_map = list(range(0x100))
+        if game == 'addmusic':
+            for byte in range(0xDA, 0x100):
+                self.byte_map[byte] = byte+0x100
+            for byte, command in Track.map_addmusic_to_standard.items():
+                self.byte_map[byte] = command
+
+        self.command_lengths = dict(Track.command_lengths)
+        if game in Track.custom_command_lengths:
+            self.command_lengths.update(Track.custom_command_lengths[game])
+
+        self.reversed_panning = game == 'hal' # Panning is reversed in HAL games
+        self.subloops = game == 'addmusic'
+        self.has_note_length_table = game != 'addmusic'
+        if game == 'addmusic':
+            self.note_length_table = Track.addmusic_note_length_table_standard
+        else:
+            self.note_length_table = Track.standard_note_length_table
+        self.formatter = TrackFormatter(game)
 
 class Pattern():
     def __init__(self, label=''):
         self.label = label
         self.tracks = [None]*8
 
-    def extract(self, spc: SPCFile, addr):
+    def extract(self, spc: SPCFile, addr, cache: ParseCache=None, dialect: Dialect=None):
+        if dialect == None:
+            dialect = Dialect.get('common')
         saved_addr = spc.tell()
         spc.seek(addr)
 
@@ -390,8 +607,13 @@ class Pattern():
         for i in range(8):
             track_addr = spc.read_int(2)
             if track_addr != 0:
-                track = Track(label=f'{self.label}_{i}')
-                track.extract(spc, track_addr, len_limit)
+                key = ParseCache.key(track_addr, len_limit, 0, dialect)
+                track = None if cache == None else cache.get(key)
+                if track == None:
+                    track = Track(label=f'{self.label}_{i}')
+                    track.extract(spc, track_addr, len_limit, cache=cache, dialect=dialect)
+                    if cache != None:
+                        cache.add(key, track)
 
                 self.tracks[i] = track
                 if len_limit == None:
@@ -403,18 +625,25 @@ class Pattern():
         return f'{self.label}: dw {', '.join('0' if track == None else track.label for track in self.tracks)}'
 
 class Tracker():
-    def __init__(self, label=''):
+    def __init__(self, label='', dialect: Dialect=None, cache: ParseCache=None):
         self.label = label
+        self.dialect = Dialect.get('common') if dialect == None else dialect
         self.commands = []
         self.patterns = {}
-
-    def extract(self, spc: SPCFile, addr):
+        self.cache = ParseCache() if cache == None else cache
+        self.selected_subsections = None
+        self.track_count = 0
+        self.duplicate_track_count = 0
+
+    def extract(self, spc: SPCFile, addr, profiler: Profiler=None):
+        if profiler == None:
+            profiler = Profiler(enabled=False)
         saved_addr = spc.tell()
         spc.seek(addr)
 
         command_addrs = []
-        pattern_i = 0
         used_patterns = {}
+        tracks_by_fingerprint = {}
         while True:
             command_addrs.append(spc.tell())
             command = spc.read_int(2)
@@ -429,26 +658,26 @@ class Tracker():
                 if command in used_patterns:
                     label = used_patterns[command]
                 else:
-                    label = f'.pattern{pattern_i}'
+                    label = f'.pattern{self.cache.pattern_count}'
                     used_patterns[command] = label
-                    pattern_i += 1
+                    self.cache.pattern_count += 1
                     pattern = Pattern(label=label)
-                    pattern.extract(spc, command)
+                    pattern.extract(spc, command, cache=self.cache, dialect=self.dialect)
 
-                    # Deduplicate tracks
-                    for i, track in enumerate(pattern.tracks):
-                        if track == None:
-                            break
-                        duplicate = False
-                        for other_pattern in self.patterns.values():
-                            for other_track in other_pattern.tracks:
-                                if track == other_track:
-                                    duplicate = True
-                                    #print(f'Duplicate: {track.label} = {other_track.label}')
-                                    pattern.tracks[i] = copy.deepcopy(other_track)
-                                    break
-                            if duplicate:
+                    with profiler.stage('dedup'):
+                        # Deduplicate tracks against earlier patterns, duplicates share the earlier Track
+                        fingerprints = [None if track == None else track.fingerprint() for track in pattern.tracks]
+                        for i, track in enumerate(pattern.tracks):
+                            if track == None:
                                 break
+                            self.track_count += 1
+                            if fingerprints[i] in tracks_by_fingerprint:
+                                #print(f'Duplicate: {track.label} = {tracks_by_fingerprint[fingerprints[i]].label}')
+                                pattern.tracks[i] = tracks_by_fingerprint[fingerprints[i]]
+                                self.duplicate_track_count += 1
+                        for i, track in enumerate(pattern.tracks):
+                            if track != None:
+                                tracks_by_fingerprint.setdefault(fingerprints[i], track)
                     self.patterns[label] = pattern
                 self.commands.append([label])
 
@@ -475,20 +704,35 @@ class Tracker():
         return asm
 
     def subsections(self):
-        subsections = {}
+        if self.selected_subsections != None:
+            return self.selected_subsections
+        return self.cache.subsections
+
+    def select_subsections(self):
+        # with a cache shared by several trackers, only keeps the subsections the tracks of this one call
+        called = set()
         for pattern in self.patterns.values():
             for track in pattern.tracks:
                 if track != None:
-                    for command in track.commands:
-                        if command[0] == 0xEF:
-                            subsections[command[1].label] = command[1]
-
-        return subsections
+                    called.update(subsection.label for subsection in track.commands.subsections)
+        missing = called-self.cache.subsections.keys()
+        if len(missing) > 0:
+            raise AssertionError(f'{self.label} calls undefined subsections {', '.join(sorted(missing))}')
+        self.selected_subsections = {label: subsection for label, subsection in self.cache.subsections.items() if label in called}
+
+    def lower_subloops(self, to_subsections=False):
+        # addmusic subloops become subsection calls where possible with to_subsections, otherwise they are unrolled
+        bodies = {} if to_subsections else None
+        for track in list(self.tracks_and_subsections()):
+            track.lower_subloops(bodies, self.subsections())
 
     def tracks_and_subsections(self):
+        # shared tracks are only yielded once
+        seen = set()
         for pattern in self.patterns.values():
             for track in pattern.tracks:
-                if track != None:
+                if track != None and not id(track) in seen:
+                    seen.add(id(track))
                     yield track
         for subsection in self.subsections().values():
             yield subsection
@@ -508,6 +752,11 @@ class Tracker():
 
         return (used_instrs, used_perc_instrs)
 
+    def dedup_rate(self):
+        if self.track_count == 0:
+            return 0.0
+        return self.duplicate_track_count/self.track_count
+
     def perc_base(self):
         perc_base = 0
         for track in self.tracks_and_subsections():